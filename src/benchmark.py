@@ -0,0 +1,414 @@
+"""
+Benchmarks the stages of a build against a local stand-in for the RotMG servers.
+
+A local HTTP server serves a fake `/app/init` and a build CDN, hosting `checksum.json` and gzipped build
+files generated at the given sizes and counts. Unity asset files (e.g. `resources.assets`, `sharedassets0.assets`)
+are copied into the build from `--unity-dir`, extraction is skipped without them.
+Each stage is timed separately, and the results are written as JSON which can be compared between runs:
+
+    python src/benchmark.py --files 200 --file-size 262144 --unity-dir ./fixtures --output before.json
+    python src/benchmark.py --files 200 --file-size 262144 --unity-dir ./fixtures --compare before.json
+"""
+
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from time import perf_counter
+
+# keep the caches, stores and outputs of the benchmark away from the real ones
+BENCHMARK_DIR = Path(tempfile.mkdtemp(prefix="rotmg-benchmark-"))
+os.environ["EXTRACTOR_OUTPUT_DIR"] = str(BENCHMARK_DIR / "output")
+
+from tabulate import tabulate
+
+from classes import AppSettings
+from classes import Constants
+from classes import DownloadCache
+from classes import metrics
+from functions import *
+from main import output_build
+
+# version of the results format, bump if the results are no longer comparable
+RESULTS_VERSION = 2
+
+# ./output/benchmarks - default location of the results
+RESULTS_DIR = Path(__file__).parent.parent / "output" / "benchmarks"
+
+BUILD_ID = "rotmg-exalt-win-64"
+DATA_DIR = "RotMG Exalt_Data"
+
+
+class CDNRequestHandler(SimpleHTTPRequestHandler):
+    """ Serves the files of the fake CDN, and the app settings at `/app/init` """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, app_init=b"", **kwargs):
+        self.app_init = app_init
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if self.path.startswith("/app/init"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+            self.send_header("Content-Length", str(len(self.app_init)))
+            self.end_headers()
+            self.wfile.write(self.app_init)
+            return
+
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCDN:
+    """ A local HTTP server standing in for both the app settings server and the build CDN """
+
+    def __init__(self, cdn_dir: Path):
+        self.cdn_dir = cdn_dir
+        self.app_init = b""
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handler(self, *args, **kwargs):
+        return CDNRequestHandler(*args, app_init=self.app_init, directory=str(self.cdn_dir), **kwargs)
+
+    def set_build(self, build_hash, build_version):
+        self.app_init = (
+            "<AppSettings>"
+            f"<BuildId>{BUILD_ID}</BuildId>"
+            f"<BuildHash>{build_hash}</BuildHash>"
+            f"<BuildVersion>{build_version}</BuildVersion>"
+            f"<BuildCDN>{self.url}/build-release/</BuildCDN>"
+            "</AppSettings>"
+        ).encode("utf-8")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def generate_build(cdn_dir: Path, build_hash, file_count, file_size, unity_dir: Path = None, seed=0):
+    """
+    Generates a gzipped client build on the CDN, with `file_count` files of `file_size` bytes and the
+    Unity files of `unity_dir`. Half of the generated files are compressible, the other half random.
+    Returns a tuple of (file count, total size).
+    """
+
+    rng = random.Random(seed)
+    build_dir = cdn_dir / "build-release" / build_hash / BUILD_ID
+
+    files = {}
+    for i in range(file_count):
+        if i % 2 == 0:
+            data = rng.getrandbits(file_size * 8).to_bytes(file_size, "little")
+        else:
+            line = f"synthetic line {i} {rng.random()}\n".encode("utf-8")
+            data = (line * (file_size // len(line) + 1))[:file_size]
+
+        files[f"{DATA_DIR}/StreamingAssets/file_{i:05}.bin"] = data
+
+    if unity_dir is not None:
+        for file_path in sorted(Path(unity_dir).iterdir()):
+            if file_path.is_file():
+                files[f"{DATA_DIR}/{file_path.name}"] = file_path.read_bytes()
+
+    checksums = []
+    for name, data in files.items():
+        output_file = build_dir / f"{name}.gz"
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        output_file.write_bytes(gzip.compress(data, compresslevel=6))
+
+        checksums.append({
+            "file": name,
+            "checksum": hashlib.md5(data).hexdigest(),
+            "size": len(data),
+        })
+
+    write_file(build_dir / "checksum.json", json.dumps({ "files": checksums }, indent=4), overwrite=True)
+    return (len(files), sum(len(data) for data in files.values()))
+
+
+def generate_xml(text_asset_dir: Path, file_count, object_count, seed=0):
+    """ Writes `file_count` xml files of `object_count` objects and the TextAsset `manifest.json` listing them """
+
+    rng = random.Random(seed)
+    text_asset_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = { "objects": [], "tiles": [] }
+    for i in range(file_count):
+        source = "tiles" if i % 4 == 3 else "objects"
+        tag = "Ground" if source == "tiles" else "Object"
+
+        lines = [f"<{tag}s>"]
+        for j in range(object_count):
+            type_id = i * object_count + j
+            lines += [
+                f"  <{tag} type=\"0x{type_id:04x}\" id=\"Synthetic {type_id}\">",
+                f"    <Class>{rng.choice(['Equipment', 'Character', 'GameObject', 'Projectile'])}</Class>",
+                f"    <DisplayId>Synthetic Object {type_id}</DisplayId>",
+                f"    <Description>{rng.random()}</Description>",
+                f"  </{tag}>",
+            ]
+        lines.append(f"</{tag}s>")
+
+        file_name = f"synthetic_{source}_{i:03}.xml"
+        write_file(text_asset_dir / file_name, "\n".join(lines), overwrite=True)
+        manifest[source].append({ "path": f"xml/{file_name}" })
+
+    write_file(text_asset_dir / "manifest.json", json.dumps(manifest, indent=4), overwrite=True)
+
+
+def generate_assets(output_dir: Path, file_count, change_rate=0.0, seed=0):
+    """
+    Writes an extracted assets tree of text and binary files. With a `change_rate`, that fraction of the
+    files is modified, added or removed compared to the tree generated with the same `seed` and no changes.
+    """
+
+    rng = random.Random(seed)
+    changes = random.Random(seed + 1)
+
+    for i in range(file_count):
+        text = i % 3 != 0
+        data = "".join(f"line {j} {rng.random()}\n" for j in range(200)) if text else rng.getrandbits(16 * 1024 * 8).to_bytes(16 * 1024, "little")
+
+        change = changes.random() < change_rate
+        if change and i % 5 == 0:
+            continue  # removed
+
+        if change:
+            if text:
+                data = data.replace("line 1", "changed line 1")
+            else:
+                data = data[::-1]
+
+        file_dir, ext, mode = ("TextAsset", "txt", "w") if text else ("Sprite", "png", "wb")
+        write_file(output_dir / file_dir / f"asset_{i:05}.{ext}", data, mode, overwrite=True)
+
+        if change and i % 5 == 1:
+            write_file(output_dir / file_dir / f"added_{i:05}.{ext}", data, mode, overwrite=True)
+
+
+def run_benchmark(name, func, repeat, setup=None):
+    """
+    Times `func` `repeat` times, calling `setup` (untimed) before each run. Both are given the run number.
+    Returns the run times with their summary, and the counters recorded by the last run.
+    """
+
+    print(f"Benchmarking {name}...")
+
+    runs = []
+    for run in range(repeat):
+        if setup is not None:
+            setup(run)
+
+        job_metrics = metrics.start(benchmark=name)
+        start_time = perf_counter()
+        func(run)
+        runs.append(perf_counter() - start_time)
+
+    return {
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "counters": job_metrics.to_dict()["counters"],
+    }
+
+
+def run_benchmarks(args):
+    """ Generates the inputs and runs every benchmark. Returns the results. """
+
+    results = {}
+    cdn_dir = BENCHMARK_DIR / "cdn"
+    build_hash = hashlib.md5(f"{args.files} {args.file_size} {args.seed}".encode("utf-8")).hexdigest()
+
+    print(f"Generating a build of {args.files} files ({format_size(args.file_size)} each)...")
+    file_count, build_size = generate_build(cdn_dir, build_hash, args.files, args.file_size, args.unity_dir, args.seed)
+
+    with FakeCDN(cdn_dir) as cdn:
+        cdn.set_build(build_hash, "benchmark")
+        app_settings = AppSettings(cdn.url).client
+        build_url = app_settings["build_cdn"] + app_settings["build_hash"] + "/" + app_settings["build_id"]
+
+        files_dir = BENCHMARK_DIR / "files"
+
+        # every run downloads into an empty cache
+        def download_setup(run):
+            remove_path(files_dir)
+            remove_path(BENCHMARK_DIR / "download_cache")
+
+        def download(run):
+            # the later benchmarks would time their work on missing input
+            if download_client_assets(build_url, files_dir, args.workers, DownloadCache(BENCHMARK_DIR / "download_cache")) is None:
+                raise RuntimeError("Downloading the benchmark build failed, see the log above")
+
+        results["download_client_assets"] = run_benchmark("download_client_assets", download, args.repeat, download_setup)
+
+        # the same build again, every file is linked from the cache
+        results["download_client_assets_cached"] = run_benchmark(
+            "download_client_assets_cached", download, args.repeat, lambda run: remove_path(files_dir)
+        )
+
+        for result in (results["download_client_assets"], results["download_client_assets_cached"]):
+            result["files"] = file_count
+            result["bytes"] = build_size
+
+    # extraction, starting from an empty extraction cache each time
+    extract_dir = BENCHMARK_DIR / "extract"
+    if args.unity_dir is not None:
+        def extract_setup(run):
+            remove_path(extract_dir)
+            remove_path(Constants.EXTRACT_CACHE_DIR)
+
+        results["extract_unity_assets"] = run_benchmark(
+            "extract_unity_assets",
+            lambda run: extract_unity_assets(files_dir, extract_dir / "extracted_assets", extract_dir / "asset_manifest.jsonl", args.workers),
+            args.repeat,
+            extract_setup
+        )
+    else:
+        results["extract_unity_assets"] = { "skipped": "no --unity-dir given" }
+
+    xml_dir = BENCHMARK_DIR / "xml"
+    generate_xml(xml_dir / "input" / "TextAsset", args.xml_files, args.xml_objects, args.seed)
+    results["merge_xml_files"] = run_benchmark(
+        "merge_xml_files",
+        lambda run: merge_xml_files(xml_dir / "input" / "TextAsset" / "manifest.json", xml_dir / "input", xml_dir / "output"),
+        args.repeat,
+        lambda run: remove_path(xml_dir / "output")
+    )
+    results["merge_xml_files"]["files"] = args.xml_files
+    results["merge_xml_files"]["objects"] = args.xml_files * args.xml_objects
+
+    # two separately written trees, so no files are shared hardlinks
+    diff_dir = BENCHMARK_DIR / "diff"
+    generate_assets(diff_dir / "old", args.assets, seed=args.seed)
+    generate_assets(diff_dir / "new", args.assets, args.change_rate, seed=args.seed)
+    results["diff_directories"] = run_benchmark(
+        "diff_directories",
+        lambda run: diff_directories(diff_dir / "new", diff_dir / "old", args.workers),
+        args.repeat
+    )
+    results["diff_directories"]["files"] = args.assets
+
+    # publishing a work directory, as a new build hash each run
+    work_dir = BENCHMARK_DIR / "work"
+    publish_dir = BENCHMARK_DIR / "publish"
+
+    def output_setup(run):
+        remove_path(work_dir)
+        shutil.copytree(diff_dir / "new", work_dir / "extracted_assets")
+        write_file(work_dir / "build_hash.txt", f"{build_hash}-{run}", overwrite=True)
+
+    results["output_build"] = run_benchmark(
+        "output_build",
+        # without the wait at the end, which would be most of the time measured
+        lambda run: output_build("Benchmark", "Client", { "build_hash": f"{build_hash}-{run}" }, work_dir, publish_dir, settle_time=0),
+        args.repeat,
+        output_setup
+    )
+    results["output_build"]["files"] = args.assets
+
+    return results
+
+
+def compare_results(previous, current):
+    """ Prints the median time of each benchmark next to a previous run's """
+
+    if previous.get("version") != current["version"]:
+        print(f"Results version {previous.get('version')} can't be compared with version {current['version']}")
+        return
+
+    if previous["config"] != current["config"]:
+        print("Warning: the benchmarks were run with a different config")
+
+    rows = []
+    for name, result in current["results"].items():
+        previous_result = previous["results"].get(name, {})
+        if "median" not in result or "median" not in previous_result:
+            rows.append([name, previous_result.get("median"), result.get("median"), ""])
+            continue
+
+        change = (result["median"] - previous_result["median"]) / previous_result["median"] * 100
+        rows.append([name, previous_result["median"], result["median"], f"{change:+.1f}%"])
+
+    print(tabulate(rows, headers=["benchmark", "previous (s)", "current (s)", "change"], floatfmt=".3f"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the extractor against a local fake CDN")
+    parser.add_argument("--files", type=int, default=200, help="number of generated build files")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="size of each generated build file in bytes")
+    parser.add_argument("--unity-dir", type=Path, help="directory of Unity asset files to add to the build and extract")
+    parser.add_argument("--xml-files", type=int, default=20, help="number of generated xml files to merge")
+    parser.add_argument("--xml-objects", type=int, default=500, help="number of objects in each xml file")
+    parser.add_argument("--assets", type=int, default=1000, help="number of files in the generated extracted assets trees")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="fraction of the assets changed between the diffed trees")
+    parser.add_argument("--workers", type=int, default=Constants.EXTRACT_WORKERS, help="download/extract/diff workers")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times each benchmark is run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated files")
+    parser.add_argument("--output", type=Path, help="results file, default is ./output/benchmarks/{timestamp}.json")
+    parser.add_argument("--compare", type=Path, help="previous results file to compare with")
+    parser.add_argument("--keep", action="store_true", help=f"keep the generated files in {BENCHMARK_DIR}")
+    args = parser.parse_args()
+
+    # the webhook is never sent for benchmark builds
+    Constants.DISCORD_WEBHOOK_URL = ""
+
+    try:
+        results = run_benchmarks(args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(BENCHMARK_DIR, ignore_errors=True)
+
+    config = vars(args).copy()
+    for key in ["output", "compare", "keep"]:
+        del config[key]
+    config["unity_files"] = sorted(path.name for path in args.unity_dir.iterdir()) if args.unity_dir else []
+    config.pop("unity_dir")
+
+    output = {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now().astimezone().isoformat(),
+        "system": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": config,
+        "results": results,
+    }
+
+    output_file = args.output or RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    write_file(output_file, json.dumps(output, indent=4), overwrite=True)
+    print(f"Results written to {output_file}")
+
+    rows = [[name, result.get("median"), result.get("min"), result.get("skipped", "")] for name, result in results.items()]
+    print(tabulate(rows, headers=["benchmark", "median (s)", "min (s)", ""], floatfmt=".3f"))
+
+    if args.compare is not None:
+        compare_results(read_json(args.compare), output)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -4,13 +4,20 @@ from .Constants import APP_INIT_PATH
 
 
 class AppSettings:
-    def __init__(self, url):
+    def __init__(self, url, xml=None):
+        """ Fetches the app settings from `url`, or parses an already downloaded `/app/init` response from `xml` """
         self.url = url
-        self.__get()
+        if xml is None:
+            self.__get()
+        else:
+            self.__parse(xml)
 
     def __get(self):
         url = self.url + APP_INIT_PATH
-        self.xml = urllib.request.urlopen(url).read()
+        self.__parse(urllib.request.urlopen(url).read())
+
+    def __parse(self, xml):
+        self.xml = xml
         data = xmltodict.parse(self.xml)
 
         # <BuildId>rotmg-exalt-win-64</BuildId>
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import random
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+from classes import Constants
+from .AppSettings import AppSettings
+from .CustomLogger import logger
+
+
+class BuildPoller:
+    """
+    Polls every environment's `/app/init` concurrently on an asyncio event loop, and dispatches a build job
+    whenever an environment's BuildHash changes.
+
+    Requests share one connection pool and are conditional (If-None-Match / If-Modified-Since) when the
+    server returns an ETag or Last-Modified header, so an unchanged environment costs a 304.
+
+    `dispatch(prod_name, build_name, app_settings)` is called for each job in a worker thread, running up to
+    `max_jobs` jobs at once. A job which raises or returns False is dispatched again on the next poll. Each job runs in its own context, so it has its own log file and indentation.
+    Jobs for the same environment and build type never run at the same time.
+    """
+
+    def __init__(self, urls, dispatch, intervals=Constants.POLL_INTERVALS, jitter=Constants.POLL_JITTER, max_jobs=Constants.BUILD_JOBS):
+        self.urls = urls
+        self.dispatch = dispatch
+        self.intervals = intervals
+        self.jitter = jitter
+        self.max_jobs = max_jobs
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=len(urls))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # prod_name -> headers for the next conditional request
+        self.validators = {}
+
+        # (prod_name, build_name) -> last dispatched build hash
+        self.build_hashes = {}
+
+        # (prod_name, build_name) -> lock held while its job runs
+        self.job_locks = {}
+
+        self.jobs = None
+        self.job_slots = None
+
+    def run(self):
+        """ Polls forever """
+        asyncio.run(self.__run())
+
+    async def __run(self):
+        self.jobs = asyncio.Queue()
+        self.job_slots = asyncio.Semaphore(self.max_jobs)
+
+        pollers = [self.__poll(prod_name, url) for prod_name, url in self.urls.items()]
+        await asyncio.gather(self.__run_jobs(), *pollers)
+
+    async def __poll(self, prod_name, url):
+        loop = asyncio.get_running_loop()
+        interval = self.intervals.get(prod_name, Constants.POLL_INTERVAL) * 60
+
+        while True:
+            try:
+                app_settings = await loop.run_in_executor(None, self.fetch, prod_name, url)
+            except Exception as e:
+                # e.g. a connection error or a malformed response, the next poll tries again
+                logger.log(logging.ERROR, f"Failed to check {prod_name} for new builds. Error: {e}")
+                app_settings = None
+
+            if app_settings is not None:
+                await self.__queue_builds(prod_name, app_settings)
+
+            await asyncio.sleep(interval + random.uniform(0, self.jitter))
+
+    async def __queue_builds(self, prod_name, app_settings: AppSettings):
+        builds = [("Client", app_settings.client)]
+        if Constants.EXTRACT_LAUNCHER:
+            builds.append(("Launcher", app_settings.launcher))
+
+        for build_name, build_settings in builds:
+            key = (prod_name, build_name)
+            if self.build_hashes.get(key) == build_settings["build_hash"]:
+                continue
+
+            self.build_hashes[key] = build_settings["build_hash"]
+            await self.jobs.put((prod_name, build_name, build_settings))
+
+    async def __run_jobs(self):
+        executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+
+        running = set()
+
+        while True:
+            job = await self.jobs.get()
+
+            # keep a reference to the task until it's done
+            task = asyncio.ensure_future(self.__run_job(executor, *job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    async def __run_job(self, executor, prod_name, build_name, build_settings):
+        loop = asyncio.get_running_loop()
+        key = (prod_name, build_name)
+        job_lock = self.job_locks.setdefault(key, asyncio.Lock())
+
+        async with job_lock, self.job_slots:
+            # a fresh context per job, executor threads would otherwise share the previous job's log file
+            context = contextvars.copy_context()
+
+            try:
+                result = await loop.run_in_executor(executor, context.run, self.__dispatch, prod_name, build_name, build_settings)
+            except Exception as e:
+                logger.log(logging.ERROR, f"{prod_name} {build_name} failed. Error: {e}")
+                result = False
+
+            # forget the hash, so the build is retried on the next poll
+            if result is False and self.build_hashes.get(key) == build_settings["build_hash"]:
+                logger.log(logging.INFO, f"{prod_name} {build_name} will be retried on the next poll")
+                self.build_hashes.pop(key, None)
+                self.validators.pop(prod_name, None)
+
+    def __dispatch(self, prod_name, build_name, build_settings):
+        logger.setJob(f"{prod_name} {build_name}")
+        try:
+            return self.dispatch(prod_name, build_name, build_settings)
+        finally:
+            logger.closeFileLog()
+
+    def fetch(self, prod_name, url):
+        """ Requests an environment's app settings. Returns None if they haven't changed since the last request. """
+
+        response = self.session.get(url + Constants.APP_INIT_PATH, headers=self.validators.get(prod_name, {}), timeout=30)
+        if response.status_code == 304:
+            return None
+
+        response.raise_for_status()
+
+        validators = {}
+        if "ETag" in response.headers:
+            validators["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        self.validators[prod_name] = validators
+
+        return AppSettings(url, response.content)
@@ -0,0 +1,63 @@
+import os
+import json
+import threading
+from pathlib import Path
+
+from classes import Constants
+
+
+class BuildRegistry:
+    """
+    Records which builds have already been processed, keyed by build type (Client/Launcher) and build hash.
+    Environments often point at the same BuildHash, so a build published by one environment is reused by
+    the others instead of being downloaded and extracted again. Files shared between different builds are
+    already deduplicated per file by the `DownloadCache` (checksum) and `PublishStore` (content hash).
+    """
+
+    # (build_name, build_hash) -> lock held while that build is being processed
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, registry_dir: Path = Constants.BUILD_REGISTRY_DIR):
+        self.registry_dir = Path(registry_dir)
+        self.registry_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, build_name, build_hash) -> Path:
+        return self.registry_dir / build_name.lower() / f"{build_hash}.json"
+
+    def lock(self, build_name, build_hash) -> threading.Lock:
+        """ Returns the lock for a build, so only one environment processes it while the others wait to reuse it """
+        with BuildRegistry.locks_lock:
+            return BuildRegistry.locks.setdefault((build_name, build_hash), threading.Lock())
+
+    def get(self, build_name, build_hash):
+        """ Returns the record of a processed build ({publish_dir, exalt_version, prod_name}), or None if it needs to be processed """
+
+        record_file = self.path(build_name, build_hash)
+        if not record_file.is_file():
+            return None
+
+        with open(record_file) as file:
+            record = json.load(file)
+
+        # the published directory may have been deleted since
+        if not Path(record["publish_dir"]).is_dir():
+            return None
+
+        return record
+
+    def add(self, build_name, build_hash, prod_name, publish_dir: Path, exalt_version=""):
+        record_file = self.path(build_name, build_hash)
+        record_file.parent.mkdir(parents=True, exist_ok=True)
+
+        record = {
+            "prod_name": prod_name,
+            "publish_dir": str(publish_dir),
+            "exalt_version": exalt_version,
+        }
+
+        temp_file = record_file.with_name(f"{record_file.name}.{threading.get_ident()}.tmp")
+        with open(temp_file, "w") as file:
+            json.dump(record, file, indent=4)
+
+        os.replace(temp_file, record_file)
@@ -1,3 +1,4 @@
+import os
 import pathlib
 from dotenv import dotenv_values
 
@@ -7,6 +8,8 @@ ENV = dotenv_values()
 # Preferences #
 ###############
 CREATE_CURRENT_ZIP = ENV["EXTRACTOR_CURRENT_ZIP"] == "true"
+# also publish current.tar.zst, needs the zstandard package
+CREATE_CURRENT_TAR_ZST = ENV.get("EXTRACTOR_CURRENT_TAR_ZST") == "true"
 TESTING_BUILDS = ENV["EXTRACTOR_TESTING_BUILDS"] == "true"
 EXTRACT_LAUNCHER = ENV["EXTRACTOR_LAUNCHER"] == "true"
 
@@ -16,6 +19,52 @@ IDA_SERVER = ENV["EXTRACTOR_IDA_SERVER"]
 IDA_CMD = ENV["EXTRACTOR_IDA_CMD"]
 IDA_WORKDIR = pathlib.Path(ENV["EXTRACTOR_IDA_WORKDIR"])
 
+# "objects" logs a line for every extracted object, "summary" only the number of objects per type and the throughput
+LOG_VERBOSITY = ENV.get("EXTRACTOR_LOG_VERBOSITY") or "objects"
+
+# format and write the logs on a background thread
+LOG_ASYNC = (ENV.get("EXTRACTOR_LOG_ASYNC") or "true") == "true"
+
+# number of files downloaded at once (also the size of the HTTP connection pool)
+DOWNLOAD_WORKERS = int(ENV.get("EXTRACTOR_DOWNLOAD_WORKERS") or 8)
+
+# times a failed download is retried (resuming where it stopped), waiting about BACKOFF * 2^n seconds between attempts
+DOWNLOAD_RETRIES = int(ENV.get("EXTRACTOR_DOWNLOAD_RETRIES") or 5)
+DOWNLOAD_BACKOFF = float(ENV.get("EXTRACTOR_DOWNLOAD_BACKOFF") or 2)
+
+# number of builds (environment + client/launcher) processed at once
+# each build also runs its own stage, extraction and download workers, so raise this carefully
+BUILD_JOBS = int(ENV.get("EXTRACTOR_BUILD_JOBS") or 2)
+
+# number of processes extracting unity asset files at once per build, 1 extracts them one at a time
+# defaults to the CPUs shared between the builds running at once
+EXTRACT_WORKERS = int(ENV.get("EXTRACTOR_EXTRACT_WORKERS") or max((os.cpu_count() or 1) // BUILD_JOBS, 1))
+
+# number of threads compressing archive entries (current.zip, build_files)
+ARCHIVE_WORKERS = int(ENV.get("EXTRACTOR_ARCHIVE_WORKERS") or os.cpu_count() or 1)
+
+# number of build stages (e.g. unity extraction, il2cpp dump, archiving) run at once
+STAGE_WORKERS = int(ENV.get("EXTRACTOR_STAGE_WORKERS") or 4)
+
+# number of threads encoding textures/sprites to png per asset file, and how many decoded images may wait for them
+ENCODE_WORKERS = int(ENV.get("EXTRACTOR_ENCODE_WORKERS") or 4)
+ENCODE_QUEUE_SIZE = ENCODE_WORKERS * 2
+
+# memory in MB for the decoded textures kept per asset file, so sprites sharing an atlas don't decode it again
+# the budget is per extraction worker, so up to BUILD_JOBS * EXTRACT_WORKERS times this may be used at once
+TEXTURE_CACHE_SIZE = int(float(ENV.get("EXTRACTOR_TEXTURE_CACHE_SIZE") or 512) * 1024 ** 2)
+
+# minutes the external tools may run before they're stopped
+UNPACKER_TIMEOUT = float(ENV.get("EXTRACTOR_UNPACKER_TIMEOUT") or 10) * 60
+IL2CPP_TIMEOUT = float(ENV.get("EXTRACTOR_IL2CPP_TIMEOUT") or 30) * 60
+IDA_TIMEOUT = float(ENV.get("EXTRACTOR_IDA_TIMEOUT") or 240) * 60
+
+# number of il2cpp dumps kept in the cache
+IL2CPP_CACHE_SIZE = int(ENV.get("EXTRACTOR_IL2CPP_CACHE_SIZE") or 5)
+
+# maximum size of the download cache in GB, least recently used files are evicted past this
+CACHE_MAX_SIZE = int(float(ENV.get("EXTRACTOR_CACHE_MAX_SIZE") or 10) * 1024 ** 3)
+
 #############
 # URL Hosts #
 #############
@@ -30,6 +79,15 @@ if TESTING_BUILDS:
     ROTMG_URLS["Testing4"] =  "https://rotmgtesting4.appspot.com"
     ROTMG_URLS["Testing5"] =  "https://rotmgtesting5.appspot.com"
 
+# minutes between checking each environment for a new build, e.g. EXTRACTOR_POLL_INTERVAL_TESTING=30
+# up to POLL_JITTER seconds are added to each wait, so the environments aren't requested in lockstep
+POLL_INTERVAL = float(ENV.get("EXTRACTOR_POLL_INTERVAL") or 10)
+POLL_INTERVALS = {
+    prod_name: float(ENV.get(f"EXTRACTOR_POLL_INTERVAL_{prod_name.upper()}") or POLL_INTERVAL)
+    for prod_name in ROTMG_URLS
+}
+POLL_JITTER = float(ENV.get("EXTRACTOR_POLL_JITTER") or 30)
+
 
 WEBSERVER_URL = ENV["HTTP"] + ENV["EXTRACTOR_URL"]
 
@@ -54,11 +112,30 @@ SRC_DIR = pathlib.Path(__file__).parent.parent
 ROOT_DIR = SRC_DIR.parent
 
 # ./output - all files, including temp outputted by the program
-OUTPUT_DIR = ROOT_DIR / "output"
+# can also be set in the environment, e.g. the benchmarks keep their caches and outputs in their own directory
+OUTPUT_DIR = pathlib.Path(os.environ.get("EXTRACTOR_OUTPUT_DIR") or ENV.get("EXTRACTOR_OUTPUT_DIR") or ROOT_DIR / "output")
 
 # ./output/publish - published outputs visible on the web server
 PUBLISH_DIR = OUTPUT_DIR / "publish"
 
+# ./output/cache - persistent content-addressed store of downloaded build files
+CACHE_DIR = OUTPUT_DIR / "cache"
+
+# ./output/objects - content-addressed store which the published files are hardlinked to
+OBJECTS_DIR = OUTPUT_DIR / "objects"
+
+# ./output/extract_cache - which files each unity object was extracted to, keyed by the object's data
+EXTRACT_CACHE_DIR = OUTPUT_DIR / "extract_cache"
+
+# ./output/builds - which builds have been processed, and where they were published
+BUILD_REGISTRY_DIR = OUTPUT_DIR / "builds"
+
+# ./output/il2cpp_cache - Il2CppInspector dumps, keyed by the hashes of their inputs
+IL2CPP_CACHE_DIR = OUTPUT_DIR / "il2cpp_cache"
+
+# ./output/metrics - prometheus metrics of the latest builds, point the node exporter's textfile collector here
+METRICS_DIR = pathlib.Path(ENV.get("EXTRACTOR_METRICS_DIR") or OUTPUT_DIR / "metrics")
+
 # ./output/temp - temporary directory cleared everytime the program is run
 TEMP_DIR = OUTPUT_DIR / "temp"
 
@@ -1,17 +1,28 @@
 import io
+import time
+import atexit
 import logging
+import queue
 import sys
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from pathlib import Path
 
 from classes import Constants
 
 
+# per object lines (e.g. every extracted asset), only logged when `Constants.LOG_VERBOSITY` is "objects"
+DETAIL = 15
+logging.addLevelName(DETAIL, "DETAIL")
+
+
 class Logger:
 
     def __init__(self):
         self.logger = logging.getLogger()
         self.initialized = False
+        self.listener = None
 
     def setup(self):
         if self.initialized:
@@ -19,28 +30,74 @@ class Logger:
 
         self.logger.addFilter(IndentFilter())
         self.logger.addFilter(LevelFilter())
+        self.logger.addFilter(JobFilter())
 
         self.formatter = logging.Formatter(
-            fmt="%(indent_level)s%(opt_level)s%(message)s",
+            fmt="%(stage_prefix)s%(indent_level)s%(opt_level)s%(message)s",
+            datefmt="%Y-%m-%d %I:%M:%S %p"
+        )
+
+        # the console is shared by every job, so its lines are prefixed with the job name
+        self.console_formatter = logging.Formatter(
+            fmt="%(job_prefix)s%(stage_prefix)s%(indent_level)s%(opt_level)s%(message)s",
             datefmt="%Y-%m-%d %I:%M:%S %p"
         )
 
         self.setupHandlers()
 
-        self.logger.setLevel(logging.INFO)
+        self.logger.setLevel(self.level())
         self.initialized = True
 
+    def level(self):
+        """ Returns the logging level of `Constants.LOG_VERBOSITY` """
+        if Constants.LOG_VERBOSITY == "summary":
+            return logging.INFO
+
+        return DETAIL
+
     def setupHandlers(self):
         # Log to console
         syslog = logging.StreamHandler(sys.stdout)
-        syslog.setFormatter(self.formatter)
-        self.logger.addHandler(syslog)
+        syslog.setFormatter(self.console_formatter)
+
+        # Log to the current job's file
+        handlers = [syslog, JobFileHandler()]
+
+        if not Constants.LOG_ASYNC:
+            for handler in handlers:
+                self.logger.addHandler(handler)
+            return
+
+        # records are created, formatted and written by a background thread, `log` only queues them
+        # records of other loggers (e.g. urllib3) are queued by the `AsyncHandler`
+        self.listener = LogListener(queue.Queue(), *handlers, respect_handler_level=True)
+        self.listener.start()
+        self.logger.addHandler(AsyncHandler(self.listener.queue))
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Writes the queued records, then stops the background thread """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def initWorker(self):
+        """
+        Sets up logging in a forked worker process, pass it as the `initializer` of a `ProcessPoolExecutor`.
+        The worker inherits the parent's queue, but not the thread writing it, so its records would be lost.
+        Workers log to their own handlers instead (e.g. a `BufferHandler` replayed by the parent).
+        """
+        self.listener = None
+        self.logger.handlers = []
+
+    def setFileLog(self, file_path: Path):
+        """
+        Logs to `file_path` from the current context (thread/task) and the contexts copied from it.
+        Each build job runs in its own context, so jobs running at the same time write to their own files.
+        """
 
-    def setFileLog(self, file_path: Path, clearHandlers=True):
         # Used to clear old file logs
-        if clearHandlers:
-            self.logger.handlers = []
-            self.setupHandlers()
+        self.closeFileLog()
 
         file_path.parent.mkdir(parents=True, exist_ok=True)
         filelog = logging.FileHandler(
@@ -48,29 +105,158 @@ class Logger:
             mode="w"  # clear log first
         )
         filelog.setFormatter(self.formatter)
-        self.logger.addHandler(filelog)
+        _file_log.set(filelog)
 
-    def log(self, level, msg):
-        return self.logger.log(level, msg)
+    def closeFileLog(self):
+        filelog = _file_log.get()
+        if filelog is not None:
+            if self.listener is not None:
+                # closed by the logging thread once the job's queued records are written, without waiting for other jobs' records
+                self.listener.queue.put(CloseFileLog(filelog))
+            else:
+                filelog.close()
+
+            _file_log.set(None)
+
+    def setJob(self, name):
+        """ Names the job running in the current context, console lines are prefixed with it """
+        _job_name.set(name)
+
+    def setStage(self, name):
+        """ Names the build stage running in the current context, its lines are prefixed with it so stages running at once can be told apart """
+        _stage_name.set(name)
+
+    def log(self, level, msg, *args):
+        """ Logs `msg`, formatted with `msg % args` only once it's written (if `level` is enabled) """
+        if self.listener is not None:
+            # the context is read now, as the logging thread doesn't run in it
+            if self.logger.isEnabledFor(level):
+                self.listener.queue.put((level, msg, args, IndentFilter.level, _job_name.get(), _stage_name.get(), _file_log.get(), time.time()))
+            return
+
+        return self.logger.log(level, msg, *args)
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def replay(self, records):
+        """ Logs records captured by a `BufferHandler`, keeping their indentation relative to the current level """
+        base_level = IndentFilter.level
+        for level, msg, indent in records:
+            IndentFilter.level = base_level + indent
+            self.log(level, msg)
+
+        IndentFilter.level = base_level
 
     def printTime(self):
         self.log(logging.INFO, str(datetime.now().astimezone().strftime("%Y-%m-%dT%H:%M:%S %z %Z")))
         
     def pipe(self, pipe: io.BufferedReader):
         for line in iter(pipe.readline, b""):
-            line = line.decode().replace("\r", "").replace("\n", "")
+            line = line.decode(errors="replace").replace("\r", "").replace("\n", "")
             self.log(logging.INFO, line)
 
 
-class IndentFilter(logging.Filter):
+class ContextLevel(type):
+    """ Stores a class's `level` in a context variable, so each thread/task running in its own context has its own indentation """
+
+    @property
+    def level(cls):
+        return cls._level.get()
+
+    @level.setter
+    def level(cls, value):
+        cls._level.set(value)
+
+
+class IndentFilter(logging.Filter, metaclass=ContextLevel):
     spaces = 4
-    level = 0
+    _level = contextvars.ContextVar("indent_level", default=0)
 
     def filter(self, record):
         record.indent_level = " " * (IndentFilter.level * IndentFilter.spaces)
         return True
 
 
+class BufferHandler(logging.Handler):
+    """ Stores log records in memory (e.g. inside a worker process), so they can be replayed with `Logger.replay` """
+
+    def __init__(self):
+        super().__init__()
+        self.base_level = IndentFilter.level
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage(), IndentFilter.level - self.base_level))
+
+
+class JobFileHandler(logging.Handler):
+    """ Writes records to the file log of the context they were logged from (see `Logger.setFileLog`) """
+
+    def emit(self, record):
+        # records from other loggers (e.g. urllib3) don't go through `JobFilter`
+        filelog = record.file_log if hasattr(record, "file_log") else _file_log.get()
+        if filelog is not None:
+            filelog.handle(record)
+
+
+class AsyncHandler(QueueHandler):
+    """ Queues the records of other loggers for the `LogListener` thread, without formatting them """
+
+    def prepare(self, record):
+        return record
+
+
+class LogListener(QueueListener):
+    """
+    Writes the queued logs on a background thread. `Logger.log` queues (level, msg, args, indent level, job name, stage name, file log, time)
+    tuples instead of records, so creating the record and formatting the message happen on this thread.
+    """
+
+    def handle(self, item):
+        if isinstance(item, CloseFileLog):
+            item.filelog.close()
+            return
+
+        super().handle(item)
+
+    def prepare(self, item):
+        if isinstance(item, logging.LogRecord):
+            record = item
+            record.__dict__.setdefault("indent_level", "")
+            record.__dict__.setdefault("job_prefix", "")
+            record.__dict__.setdefault("stage_prefix", "")
+        else:
+            level, msg, args, indent, job_name, stage_name, filelog, created = item
+            record = logging.LogRecord("root", level, "", 0, msg, args, None)
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            record.indent_level = " " * (indent * IndentFilter.spaces)
+            record.job_prefix = f"[{job_name}] " if job_name else ""
+            record.stage_prefix = f"[{stage_name}] " if stage_name else ""
+            record.file_log = filelog
+
+        LevelFilter().filter(record)
+        return record
+
+
+class CloseFileLog:
+    """ Queued by `Logger.closeFileLog`, the `LogListener` closes the file log once the records queued before it are written """
+
+    def __init__(self, filelog: logging.FileHandler):
+        self.filelog = filelog
+
+
+class JobFilter(logging.Filter):
+    def filter(self, record):
+        job_name = _job_name.get()
+        stage_name = _stage_name.get()
+        record.job_prefix = f"[{job_name}] " if job_name else ""
+        record.stage_prefix = f"[{stage_name}] " if stage_name else ""
+        record.file_log = _file_log.get()
+        return True
+
+
 class LevelFilter(logging.Filter):
     min_level = logging.WARNING
     def filter(self, record):
@@ -82,4 +268,9 @@ class LevelFilter(logging.Filter):
 
         return True 
 
+# the current job's file handler and name, and the name of the build stage being run
+_file_log = contextvars.ContextVar("file_log", default=None)
+_job_name = contextvars.ContextVar("job_name", default=None)
+_stage_name = contextvars.ContextVar("stage_name", default=None)
+
 logger = Logger()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import logging
+import threading
+from pathlib import Path
+
+from classes import Constants
+from .CustomLogger import logger
+
+
+class DownloadCache:
+    """
+    A persistent content-addressed store of downloaded build files, keyed by the checksums in `checksum.json`.
+    Files are hardlinked between the store and the download directory, falling back to a copy
+    when the two are on different filesystems. Least recently used files are evicted once the
+    store grows past `max_size` bytes.
+    """
+
+    # shared by every instance, as builds running at the same time use the same store
+    lock = threading.Lock()
+
+    def __init__(self, cache_dir: Path = Constants.CACHE_DIR, max_size=Constants.CACHE_MAX_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, checksum: str) -> Path:
+        """ Returns the store path of a checksum, e.g. `cache/ab/ab12cd...` """
+        checksum = checksum.lower()
+        return self.cache_dir / checksum[:2] / checksum
+
+    def has(self, checksum: str):
+        return bool(checksum) and self.path(checksum).is_file()
+
+    def get(self, checksum: str, output_file: Path):
+        """ Links the cached file to `output_file`. Returns False if the checksum isn't cached. """
+
+        if not self.has(checksum):
+            return False
+
+        cached_file = self.path(checksum)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        if output_file.exists():
+            output_file.unlink()
+
+        link_file(cached_file, output_file)
+
+        # mark as recently used
+        os.utime(cached_file)
+        return True
+
+    def add(self, checksum: str, file_path: Path):
+        """ Stores a downloaded file under its checksum """
+
+        if not checksum or self.has(checksum):
+            return
+
+        cached_file = self.path(checksum)
+        cached_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # link to a temporary name first, so other threads never see a partial file
+        temp_file = cached_file.with_name(f"{cached_file.name}.{threading.get_ident()}.tmp")
+        link_file(file_path, temp_file)
+        os.replace(temp_file, cached_file)
+        os.utime(cached_file)
+
+    def evict(self):
+        """ Deletes the least recently used files until the store is smaller than `max_size` """
+
+        with self.lock:
+            files = []
+            for file in self.cache_dir.glob("*/*"):
+                # being added by another download
+                if file.name.endswith(".tmp"):
+                    continue
+
+                stat = file.stat()
+                files.append((stat.st_mtime, stat.st_size, file))
+
+            cache_size = sum(size for _, size, _ in files)
+            if cache_size <= self.max_size:
+                return
+
+            evicted = 0
+            for _, size, file in sorted(files):
+                if cache_size <= self.max_size:
+                    break
+
+                file.unlink()
+                cache_size -= size
+                evicted += 1
+
+            logger.log(logging.INFO, f"Evicted {evicted} files from the download cache")
+
+
+def link_file(src: Path, dst: Path):
+    """ Hardlinks `src` to `dst`, or copies it if hardlinks aren't supported """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
@@ -0,0 +1,68 @@
+import os
+import json
+import threading
+from pathlib import Path
+
+from classes import Constants
+from .PublishStore import PublishStore, link_or_clone
+
+
+class ExtractCache:
+    """
+    A persistent cache of extracted Unity objects, keyed by a hash of each object's serialized data.
+    Each entry lists the files an object was extracted to, by name, sha256 hash and size. The file
+    contents aren't stored again; they are hardlinked from the `PublishStore` objects of previous builds.
+    """
+
+    def __init__(self, cache_dir: Path = Constants.EXTRACT_CACHE_DIR, store: PublishStore = None):
+        self.cache_dir = Path(cache_dir)
+        self.store = store or PublishStore()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str):
+        """ Returns the outputs (a list of {name, hash, size}) of a cached object, or None if it isn't cached or a file was removed """
+
+        entry_file = self.path(key)
+        if not entry_file.is_file():
+            return None
+
+        with open(entry_file) as file:
+            outputs = json.load(file)
+
+        for output in outputs:
+            if not self.store.path(output["hash"]).is_file():
+                return None
+
+        return outputs
+
+    def put(self, key: str, outputs):
+        """ Records the outputs of an extracted object, the files are added to the store once the build is published """
+
+        entry_file = self.path(key)
+        entry_file.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_file = entry_file.with_name(f"{entry_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_file, "w") as file:
+            json.dump(outputs, file)
+
+        os.replace(temp_file, entry_file)
+
+    def link(self, output, output_file: Path):
+        """
+        Links a cached output (from `get`) to `output_file`.
+        Returns False if the file was removed from the store since `get` (e.g. by `PublishStore.gc`).
+        """
+
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        if output_file.exists():
+            output_file.unlink()
+
+        try:
+            link_or_clone(self.store.path(output["hash"]), output_file)
+        except FileNotFoundError:
+            return False
+
+        return True
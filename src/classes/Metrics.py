@@ -0,0 +1,173 @@
+import os
+import json
+import threading
+import contextvars
+from time import perf_counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from classes import Constants
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+class Metrics:
+    """ The metrics of a single build job: wall/CPU time per stage and external tool, counters and peak memory """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.stages = {}
+        self.tools = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, wall_time, cpu_time):
+        with self.lock:
+            self.stages[name] = { "wall_seconds": wall_time, "cpu_seconds": cpu_time }
+
+    def add_tool(self, name, wall_time, cpu_time, peak_rss, exit_code):
+        with self.lock:
+            self.tools[name] = { "wall_seconds": wall_time, "cpu_seconds": cpu_time, "peak_rss_bytes": peak_rss, "exit_code": exit_code }
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def merge(self, counters):
+        """ Adds the counters of another `Metrics` (e.g. returned from a worker process) """
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({ "labels": dict(labels), "value": value })
+
+        return {
+            "labels": self.labels,
+            "stages": self.stages,
+            "tools": self.tools,
+            "counters": counters,
+            "peak_rss_bytes": peak_rss(),
+        }
+
+    def to_prometheus(self, prefix="rotmg_extractor"):
+        """ Returns the metrics in the Prometheus text format, e.g. for the node exporter's textfile collector """
+
+        lines = []
+
+        def add(name, metric_type, samples):
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for labels, value in samples:
+                labels = { **self.labels, **labels }
+                label_str = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_str}}} {value}")
+
+        add("stage_wall_seconds", "gauge", [({ "stage": stage }, times["wall_seconds"]) for stage, times in self.stages.items()])
+        add("stage_cpu_seconds", "gauge", [({ "stage": stage }, times["cpu_seconds"]) for stage, times in self.stages.items()])
+
+        # cpu time and peak memory are unknown on windows
+        for field in ["wall_seconds", "cpu_seconds", "peak_rss_bytes", "exit_code"]:
+            add(f"tool_{field}", "gauge", [({ "tool": tool }, values[field]) for tool, values in self.tools.items() if values[field] is not None])
+
+        for name, samples in self.to_dict()["counters"].items():
+            add(f"{name}_total", "counter", [(sample["labels"], sample["value"]) for sample in samples])
+
+        add("peak_rss_bytes", "gauge", [({}, peak_rss())])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRecorder:
+    """
+    Records metrics to the `Metrics` of the build job running in the current context (thread/task),
+    like `logger` does for log files. Does nothing outside of a job.
+    """
+
+    def start(self, **labels):
+        """ Starts recording a job's metrics in the current context """
+        metrics = Metrics(labels)
+        _metrics.set(metrics)
+        return metrics
+
+    def current(self) -> Metrics:
+        return _metrics.get()
+
+    @contextmanager
+    def stage(self, name):
+        """ Records the wall and CPU time of a stage. CPU time includes child processes, and other stages running at the same time. """
+        start_wall = perf_counter()
+        start_cpu = cpu_time()
+        try:
+            yield
+        finally:
+            metrics = _metrics.get()
+            if metrics is not None:
+                metrics.add_stage(name, perf_counter() - start_wall, cpu_time() - start_cpu)
+
+    def tool(self, result):
+        """ Records a `ToolResult` of an external tool run """
+        metrics = _metrics.get()
+        if metrics is not None:
+            metrics.add_tool(result.name, result.elapsed, result.cpu_time, result.peak_rss, result.returncode)
+
+    def count(self, name, value=1, **labels):
+        metrics = _metrics.get()
+        if metrics is not None:
+            metrics.count(name, value, **labels)
+
+    def merge(self, counters):
+        metrics = _metrics.get()
+        if metrics is not None:
+            metrics.merge(counters)
+
+    def write(self, work_dir: Path):
+        """ Writes the current job's metrics to `work_dir/metrics.json`, and a .prom file to `Constants.METRICS_DIR` """
+
+        metrics = _metrics.get()
+        if metrics is None:
+            return
+
+        work_dir.mkdir(parents=True, exist_ok=True)
+        with open(work_dir / "metrics.json", "w") as file:
+            json.dump(metrics.to_dict(), file, indent=4)
+
+        # written under a temporary name, as the node exporter may read it at any time
+        name = "_".join(str(value).lower() for value in metrics.labels.values()) or "extractor"
+        prom_file = Constants.METRICS_DIR / f"rotmg_extractor_{name}.prom"
+        prom_file.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_file = prom_file.with_name(f"{prom_file.name}.{threading.get_ident()}.tmp")
+        with open(temp_file, "w") as file:
+            file.write(metrics.to_prometheus())
+
+        os.replace(temp_file, prom_file)
+
+
+def cpu_time():
+    """ Returns the CPU time used by this process and its finished child processes """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss():
+    """ Returns the peak resident memory of this process or its largest child process in bytes, or None if unknown """
+    if resource is None:
+        return None
+
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return max_rss * 1024  # kilobytes on linux
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+_metrics = contextvars.ContextVar("metrics", default=None)
+
+metrics = MetricsRecorder()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import threading
+import hashlib
+import logging
+from pathlib import Path
+
+from classes import Constants
+from .CustomLogger import logger
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class PublishStore:
+    """
+    A content-addressed object store backing the published build directories.
+    Every published file is a hardlink to an object named after its sha256 hash, so identical
+    files across builds (and between `current` and the build hash directory) are stored once.
+    Objects are hardlinked from the work directory when possible, otherwise reflinked or copied.
+    """
+
+    def __init__(self, store_dir: Path = Constants.OBJECTS_DIR):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, file_hash: str) -> Path:
+        return self.store_dir / file_hash[:2] / file_hash
+
+    def add(self, file_path: Path) -> Path:
+        """ Adds a file to the store, returning the path of its object """
+
+        object_file = self.path(hash_file(file_path))
+        if object_file.exists():
+            return object_file
+
+        object_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = object_file.with_name(f"{object_file.name}.{threading.get_ident()}.tmp")
+        link_or_clone(file_path, temp_file)
+        os.replace(temp_file, object_file)
+        return object_file
+
+    def add_tree(self, src_dir: Path, copied_files=()):
+        """
+        Adds every file in `src_dir` to the store.
+        Returns a dict of relative path -> object path, files named in `copied_files` map to their source path instead.
+        """
+
+        objects = {}
+        for root, dirs, files in os.walk(src_dir):
+            root = Path(root)
+            rel_dir = root.relative_to(src_dir)
+
+            # keep empty directories
+            objects[rel_dir] = None
+
+            for file_name in files:
+                if file_name in copied_files:
+                    objects[rel_dir / file_name] = root / file_name
+                else:
+                    objects[rel_dir / file_name] = self.add(root / file_name)
+
+        return objects
+
+    def link_tree(self, objects, dst_dir: Path):
+        """ Creates `dst_dir` from the result of `add_tree`, hardlinking each object into place """
+
+        for rel_path, object_file in objects.items():
+            dst_file = dst_dir / rel_path
+
+            if object_file is None:
+                dst_file.mkdir(parents=True, exist_ok=True)
+            elif object_file.parent.parent == self.store_dir:
+                dst_file.parent.mkdir(parents=True, exist_ok=True)
+                link_or_clone(object_file, dst_file)
+            else:
+                dst_file.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(object_file, dst_file)
+
+    def gc(self):
+        """ Deletes objects which are no longer linked from any published directory """
+
+        removed = 0
+        for object_file in self.store_dir.glob("*/*"):
+            # .tmp files are being added by another build
+            if object_file.name.endswith(".tmp"):
+                continue
+
+            try:
+                if object_file.stat().st_nlink == 1:
+                    object_file.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                # removed by another build's gc
+                pass
+
+        if removed > 0:
+            logger.log(logging.INFO, f"Removed {removed} unused files from the publish store")
+
+
+def hash_file(file_path: Path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def link_or_clone(src: Path, dst: Path):
+    """ Hardlinks `src` to `dst`. If hardlinks aren't supported, attempts a reflink (copy-on-write clone) before copying. """
+
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    if not reflink_file(src, dst):
+        shutil.copy2(src, dst)
+
+
+def reflink_file(src: Path, dst: Path):
+    """ Clones `src` to `dst` with the FICLONE ioctl (btrfs, xfs). Returns False if the filesystem doesn't support it. """
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        return False
+
+    shutil.copystat(src, dst)
+    return True
@@ -0,0 +1,101 @@
+import logging
+import contextvars
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from classes import Constants
+from .CustomLogger import logger, IndentFilter
+from .Metrics import metrics
+
+
+class Stage:
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+
+
+class StageGraph:
+    """
+    Runs the stages of a build pipeline as a dependency graph, starting every stage as soon as the stages it
+    depends on have finished, so independent stages (e.g. dumping il2cpp and extracting Unity assets) overlap.
+
+    Each stage is a function taking the dict of stage name -> result of the stages which already finished.
+    A stage fails if it raises or returns False, and the stages depending on it are skipped.
+    The logs of each stage are written as it runs, prefixed with the stage's name.
+    """
+
+    def __init__(self, workers=Constants.STAGE_WORKERS):
+        self.workers = workers
+        self.stages = {}
+
+    def add(self, name, func, deps=()):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage \"{name}\" depends on unknown stage \"{dep}\"")
+
+        self.stages[name] = Stage(name, func, deps)
+
+    def run(self):
+        """ Runs every stage. Returns the dict of stage name -> result, or None if a stage failed. """
+
+        results = {}
+        failed = set()
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+
+                for stage in list(pending.values()):
+                    if any(dep in failed for dep in stage.deps):
+                        logger.log(logging.WARNING, f"Skipping stage \"{stage.name}\", a stage it depends on failed")
+                        failed.add(stage.name)
+                        del pending[stage.name]
+
+                    elif all(dep in results for dep in stage.deps):
+                        # each stage runs in a copy of the current context, so it has its own log indentation and prefix
+                        context = contextvars.copy_context()
+                        future = executor.submit(context.run, self.__run_stage, stage, dict(results))
+                        running[future] = stage
+                        del pending[stage.name]
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    result, error, elapsed = future.result()
+
+                    logger.log(logging.INFO, f"[{stage.name}] {'failed' if error else 'finished'} in {elapsed:.2f}s")
+                    if error:
+                        IndentFilter.level += 1
+                        logger.log(logging.ERROR, f"Stage \"{stage.name}\" failed. Error: {error}")
+                        IndentFilter.level -= 1
+
+                    if error:
+                        failed.add(stage.name)
+                    else:
+                        results[stage.name] = result
+
+        if failed:
+            return None
+
+        return results
+
+    def __run_stage(self, stage: Stage, results):
+        error = None
+        result = None
+        start_time = perf_counter()
+
+        logger.setStage(stage.name)
+        with metrics.stage(stage.name):
+            try:
+                result = stage.func(results)
+                if result is False:
+                    error = "returned False"
+            except Exception as e:
+                error = repr(e)
+
+        return (result, error, perf_counter() - start_time)
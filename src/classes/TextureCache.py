@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+from classes import Constants
+
+
+class TextureCache:
+    """
+    An in-memory LRU cache of decoded textures, keyed by (asset file name, path id).
+    Decoding a texture (e.g. DXT/ETC compressed) is much slower than cropping it, and many sprites are cropped
+    from the same atlas, so each decoded texture is kept until the cache holds more than `max_size` bytes of pixels.
+    A cache is created for each asset file, so every extraction worker process has its own `max_size` budget.
+    """
+
+    def __init__(self, max_size=Constants.TEXTURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.peak_size = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns a decoded texture, or None if it isn't cached """
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                return None
+
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """ Stores a decoded texture, evicting the least recently used textures past `max_size` """
+        with self.lock:
+            if key in self.images:
+                self.size -= image_size(self.images.pop(key))
+
+            self.images[key] = image
+            self.size += image_size(image)
+            self.misses += 1
+            self.peak_size = max(self.peak_size, self.size)
+
+            # the newest texture is kept even if it's larger than the cache, it's about to be used
+            while self.size > self.max_size and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= image_size(evicted)
+                self.evictions += 1
+
+
+def image_size(image):
+    """ Returns the approximate memory used by the pixels of a PIL image """
+    return image.width * image.height * len(image.getbands())
@@ -0,0 +1,139 @@
+import os
+import sys
+import atexit
+import logging
+import threading
+import subprocess
+import contextvars
+from time import perf_counter
+
+from .CustomLogger import logger
+from .Metrics import metrics
+
+# seconds a tool has to exit after being terminated, before it's killed
+TERMINATE_GRACE = 10
+
+
+class ToolResult:
+    def __init__(self, name, returncode, elapsed, cpu_time=None, peak_rss=None, timed_out=False):
+        self.name = name
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class ToolSupervisor:
+    """
+    Runs external tools (launcher unpacker, Il2CppInspector) with a timeout.
+    The tool's output is logged line by line as it's written, from the caller's context so it goes to the
+    job's log, while the caller's thread only waits. Its exit code, runtime, CPU time and peak memory are
+    logged and recorded in the job's metrics. Tools still running when the program exits are terminated.
+    """
+
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        atexit.register(self.terminate_all)
+
+    def run(self, name, args, timeout=None, cwd=None) -> ToolResult:
+        """ Runs `args` until it exits or `timeout` seconds have passed. The tool's stdin is empty. """
+
+        args = [str(arg) for arg in args]
+        logger.log(logging.DEBUG, f"Running {name}: {subprocess.list2cmdline(args)}")
+        start_time = perf_counter()
+
+        process = subprocess.Popen(
+            args,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL, # tools waiting for input (e.g. "Press any key to exit...") read EOF
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+
+        with self.lock:
+            self.processes.add(process)
+
+        # output is drained in the caller's context, so it's written to the caller's job log with its stage prefix
+        drain = threading.Thread(target=contextvars.copy_context().run, args=(logger.pipe, process.stdout), daemon=True)
+        drain.start()
+
+        usage = {}
+        waiter = threading.Thread(target=wait_process, args=(process, usage), daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+
+        timed_out = waiter.is_alive()
+        if timed_out:
+            logger.log(logging.ERROR, f"{name} did not exit within {timeout:.0f}s, stopping it")
+            stop_process(process, waiter)
+
+        # a child process of the tool may still have the output open, so don't wait for it forever
+        drain.join(TERMINATE_GRACE)
+        if not drain.is_alive():
+            process.stdout.close()
+
+        with self.lock:
+            self.processes.discard(process)
+
+        result = ToolResult(name, process.returncode, perf_counter() - start_time, usage.get("cpu_time"), usage.get("peak_rss"), timed_out)
+        metrics.tool(result)
+
+        summary = f"{name} exited with code {result.returncode} in {result.elapsed:.2f}s"
+        if result.peak_rss is not None:
+            summary += f" (CPU {result.cpu_time:.2f}s, peak memory {result.peak_rss / 1024 ** 2:.0f} MB)"
+        logger.log(logging.INFO if result.ok else logging.ERROR, summary)
+
+        return result
+
+    def terminate_all(self):
+        with self.lock:
+            processes = list(self.processes)
+
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+
+def wait_process(process: subprocess.Popen, usage):
+    """ Waits for the process to exit, adding its CPU time and peak memory to `usage` where `os.wait4` is available """
+
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped by `Popen` (e.g. while being terminated)
+        process.wait()
+        return
+
+    process.returncode = exit_code(status)
+    usage["cpu_time"] = rusage.ru_utime + rusage.ru_stime
+    # kilobytes on linux, bytes on macos
+    usage["peak_rss"] = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+def stop_process(process: subprocess.Popen, waiter: threading.Thread):
+    process.terminate()
+    waiter.join(TERMINATE_GRACE)
+    if waiter.is_alive():
+        process.kill()
+        waiter.join()
+
+
+def exit_code(status):
+    """ Converts a wait status to an exit code like `Popen.returncode`, negative if the process was killed by a signal """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+tools = ToolSupervisor()
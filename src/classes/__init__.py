@@ -1,3 +1,12 @@
 from .Constants import *
 from .AppSettings import *
-from .CustomLogger import *
\ No newline at end of file
+from .CustomLogger import *
+from .Metrics import *
+from .DownloadCache import *
+from .PublishStore import *
+from .ExtractCache import *
+from .TextureCache import *
+from .ToolSupervisor import *
+from .BuildPoller import *
+from .StageGraph import *
+from .BuildRegistry import *
\ No newline at end of file
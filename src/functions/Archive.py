@@ -0,0 +1,361 @@
+import os
+import time
+import zlib
+import struct
+import tarfile
+import logging
+import zipfile
+import tempfile
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from pathlib import Path
+
+from classes import Constants
+from classes import logger, metrics
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for .tar.zst archives
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+
+# compressed entries larger than this are spooled to a temporary file instead of being held in memory
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# file types which are already compressed, deflating them costs CPU for almost no size gain
+STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg",
+    ".ogg", ".mp3", ".fsb",
+    ".ress", ".resource",
+    ".gz", ".zip", ".zst", ".br", ".lz4",
+}
+
+ZSTD_LEVEL = 3
+
+# zip structures, see APPNOTE.TXT
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_UNIX = 3
+ZIP_UTF8_FLAG = 0x800
+ZIP_DIRECTORY_ATTR = 0x10
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+def create_archive(input_dir: Path, output_file: Path, previous_file: Path = None, format="zip", workers=Constants.ARCHIVE_WORKERS):
+    """
+    Archives `input_dir` to `output_file` as a "zip" or "tar.zst". Returns the output file, or None if the format isn't available.
+    Zip entries are compressed by `workers` threads, and already compressed file types (see `STORED_EXTENSIONS`) are stored.
+    Entries which are unchanged in the `previous_file` zip (same name, size and CRC) are copied from it without recompressing.
+    """
+
+    start_time = perf_counter()
+
+    if format == "zip":
+        counts = create_zip(input_dir, output_file, previous_file, workers)
+    elif format == "tar.zst":
+        counts = create_tar_zst(input_dir, output_file, workers)
+    else:
+        raise ValueError(f"Unknown archive format \"{format}\"")
+
+    if counts is None:
+        return None
+
+    for mode, count in counts.items():
+        metrics.count("archived_files", count, mode=mode)
+
+    elapsed = perf_counter() - start_time
+    summary = ", ".join(f"{count} {mode}" for mode, count in counts.items())
+    logger.log(logging.INFO, f"Archived {output_file.name} ({summary}) in {elapsed:.2f}s")
+    return output_file
+
+
+def create_zip(input_dir: Path, output_file: Path, previous_file: Path = None, workers=Constants.ARCHIVE_WORKERS):
+    """ Writes the zip for `create_archive`. Returns the number of entries compressed, stored and reused. """
+
+    previous_entries = read_zip_entries(previous_file)
+    counts = { "compressed": 0, "stored": 0, "reused": 0 }
+    central_dir = []
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    previous_context = open(previous_file, "rb") if previous_entries else nullcontext()
+
+    with previous_context as previous, open(output_file, "wb") as out, ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+
+        def write_next(pending):
+            name, file_path, future = pending.popleft()
+            entry = future.result()
+            entry["offset"] = out.tell()
+            out.write(zip_local_header(name, entry))
+
+            data = entry.pop("data", None)
+            if entry.pop("reused", False):
+                copy_zip_entry(previous, previous_entries[name], out)
+                counts["reused"] += 1
+            elif data is not None:
+                with data:
+                    data.seek(0)
+                    copy_bytes(data, out)
+                counts["compressed"] += 1
+            elif not file_path.is_dir():
+                with open(file_path, "rb") as file:
+                    copy_bytes(file, out)
+                counts["stored"] += 1
+
+            central_dir.append((name, entry))
+
+        # entries are written in order, while up to 2 per worker are being compressed ahead
+        pending = deque()
+        for name, file_path in list_archive_entries(input_dir):
+            future = executor.submit(prepare_zip_entry, file_path, previous_entries.get(name))
+            pending.append((name, file_path, future))
+            if len(pending) >= workers * 2:
+                write_next(pending)
+
+        while pending:
+            write_next(pending)
+
+        write_zip_central_dir(out, central_dir)
+
+    return counts
+
+
+def list_archive_entries(input_dir: Path):
+    """ Returns the (archive name, path) of every directory and file under `input_dir`, sorted like `shutil.make_archive` walks them """
+
+    entries = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        root = Path(root)
+        for name in dirs:
+            entries.append(((root / name).relative_to(input_dir).as_posix() + "/", root / name))
+        for name in sorted(files):
+            entries.append(((root / name).relative_to(input_dir).as_posix(), root / name))
+
+    return entries
+
+
+def prepare_zip_entry(file_path: Path, previous_entry=None):
+    """
+    Reads a file for its zip entry, run by the archive's worker threads.
+    Returns the entry's fields, the compressed data in `data` if it's deflated, or `reused` if the `previous_entry` can be copied.
+    """
+
+    stat = file_path.stat()
+    entry = {
+        "method": zipfile.ZIP_STORED,
+        "crc": 0,
+        "size": 0,
+        "compress_size": 0,
+        "dos_time": dos_time(stat.st_mtime),
+        "external_attr": (stat.st_mode & 0xFFFF) << 16,
+    }
+
+    if file_path.is_dir():
+        entry["external_attr"] |= ZIP_DIRECTORY_ATTR
+        return entry
+
+    entry["size"] = stat.st_size
+    stored = file_path.suffix.lower() in STORED_EXTENSIONS
+
+    # an unchanged file is only read for its CRC, then copied from the previous archive
+    crc = None
+    if previous_entry is not None and previous_entry.file_size == stat.st_size:
+        crc = crc32_file(file_path)
+        entry["crc"] = crc
+        if crc == previous_entry.CRC and previous_entry.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            entry["method"] = previous_entry.compress_type
+            entry["compress_size"] = previous_entry.compress_size
+            entry["reused"] = True
+            return entry
+
+    if stored:
+        entry["crc"] = crc if crc is not None else crc32_file(file_path)
+        entry["compress_size"] = stat.st_size
+        return entry
+
+    # zlib releases the GIL while compressing, so the worker threads compress in parallel
+    crc = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            data.write(compressor.compress(chunk))
+    data.write(compressor.flush())
+
+    entry["crc"] = crc
+    compress_size = data.tell()
+
+    # not worth compressing, e.g. an unknown compressed format
+    if compress_size >= stat.st_size:
+        data.close()
+        entry["compress_size"] = stat.st_size
+        return entry
+
+    entry["method"] = zipfile.ZIP_DEFLATED
+    entry["compress_size"] = compress_size
+    entry["data"] = data
+    return entry
+
+
+def read_zip_entries(zip_file: Path):
+    """ Returns a dict of name -> `zipfile.ZipInfo` of a previous archive, empty if it doesn't exist or can't be read """
+
+    if zip_file is None or not Path(zip_file).is_file():
+        return {}
+
+    try:
+        with zipfile.ZipFile(zip_file) as archive:
+            return { info.filename: info for info in archive.infolist() }
+    except (zipfile.BadZipFile, OSError) as e:
+        logger.log(logging.WARNING, f"Unable to read the previous archive {zip_file}, compressing every file. Error: {e}")
+        return {}
+
+
+def copy_zip_entry(previous, info: zipfile.ZipInfo, out):
+    """ Copies the compressed data of an entry in the `previous` zip file to `out` """
+
+    previous.seek(info.header_offset)
+    header = previous.read(ZIP_LOCAL_HEADER.size)
+    name_length, extra_length = struct.unpack_from("<HH", header, 26)
+    previous.seek(info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length)
+    copy_bytes(previous, out, info.compress_size)
+
+
+def zip_local_header(name, entry):
+    name_bytes, flags = encode_zip_name(name)
+
+    version = ZIP_VERSION
+    size, compress_size = entry["size"], entry["compress_size"]
+    extra = b""
+    if size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+        version = ZIP64_VERSION
+        extra = struct.pack("<HHQQ", 1, 16, size, compress_size)
+        size = compress_size = ZIP64_LIMIT
+
+    dos_time, dos_date = entry["dos_time"]
+    header = ZIP_LOCAL_HEADER.pack(
+        0x04034b50, version, flags, entry["method"], dos_time, dos_date,
+        entry["crc"], compress_size, size, len(name_bytes), len(extra)
+    )
+    return header + name_bytes + extra
+
+
+def write_zip_central_dir(out, central_dir):
+    """ Writes the central directory and end records, with the zip64 records if there are too many entries or the archive is too large """
+
+    start = out.tell()
+    for name, entry in central_dir:
+        name_bytes, flags = encode_zip_name(name)
+
+        # zip64 fields are only included for the values which don't fit
+        fields = []
+        size, compress_size, offset = entry["size"], entry["compress_size"], entry["offset"]
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+            size = ZIP64_LIMIT
+        if compress_size >= ZIP64_LIMIT:
+            fields.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_LIMIT
+
+        extra = b""
+        version = ZIP_VERSION
+        if fields:
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, len(fields) * 8, *fields)
+            version = ZIP64_VERSION
+
+        dos_time, dos_date = entry["dos_time"]
+        out.write(ZIP_CENTRAL_HEADER.pack(
+            0x02014b50, (ZIP_UNIX << 8) | version, version, flags, entry["method"], dos_time, dos_date,
+            entry["crc"], compress_size, size, len(name_bytes), len(extra), 0, 0, 0, entry["external_attr"], offset
+        ))
+        out.write(name_bytes + extra)
+
+    end = out.tell()
+    count = len(central_dir)
+    central_size = end - start
+
+    if count >= ZIP64_COUNT_LIMIT or start >= ZIP64_LIMIT or central_size >= ZIP64_LIMIT:
+        out.write(ZIP64_END_RECORD.pack(0x06064b50, 44, (ZIP_UNIX << 8) | ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count, central_size, start))
+        out.write(ZIP64_END_LOCATOR.pack(0x07064b50, 0, end, 1))
+        count = min(count, ZIP64_COUNT_LIMIT)
+        central_size = min(central_size, ZIP64_LIMIT)
+        start = min(start, ZIP64_LIMIT)
+
+    out.write(ZIP_END_RECORD.pack(0x06054b50, 0, 0, count, count, central_size, start, 0))
+
+
+def encode_zip_name(name):
+    """ Returns the encoded name and flags of an entry, names which aren't ascii are flagged as utf-8 """
+    try:
+        return (name.encode("ascii"), 0)
+    except UnicodeEncodeError:
+        return (name.encode("utf-8"), ZIP_UTF8_FLAG)
+
+
+def dos_time(timestamp):
+    """ Returns the (time, date) of a timestamp in the MS-DOS format used by zip files, which starts at 1980 """
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (0, (1 << 5) | 1)
+
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    )
+
+
+def crc32_file(file_path: Path):
+    crc = 0
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+
+    return crc
+
+
+def copy_bytes(src, dst, length=None):
+    """ Copies `length` bytes (or everything left) from the `src` file to `dst` """
+    while length is None or length > 0:
+        chunk = src.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+
+        dst.write(chunk)
+        if length is not None:
+            length -= len(chunk)
+
+
+def create_tar_zst(input_dir: Path, output_file: Path, workers=Constants.ARCHIVE_WORKERS):
+    """ Writes a zstd compressed tar for `create_archive`, compressed by `workers` zstd threads. Returns the number of files archived. """
+
+    if zstandard is None:
+        logger.log(logging.ERROR, f"Unable to create {output_file.name}, the zstandard package isn't installed")
+        return None
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=workers)
+    count = 0
+
+    with open(output_file, "wb") as out, compressor.stream_writer(out) as writer:
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            for name, file_path in list_archive_entries(input_dir):
+                tar.add(file_path, arcname=name.rstrip("/"), recursive=False)
+                if not file_path.is_dir():
+                    count += 1
+
+    return { "compressed": count }
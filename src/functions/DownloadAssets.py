@@ -1,30 +1,164 @@
 
-import os
-import urllib
-import shutil
 import ntpath
-import gzip
+import contextvars
+import zlib
+import random
+import hashlib
 import zipfile
 import logging
-from urllib.error import HTTPError
+import requests
+import urllib3
+from requests import HTTPError
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter, sleep
 from pathlib import Path
 
 from classes import Constants
-from classes import logger, IndentFilter
+from classes import logger, IndentFilter, DownloadCache, metrics
 from functions.ExtractAssets import unpack_launcher_assets
-from .File import read_json
+from .File import read_json, format_size, remove_path
 
+CHUNK_SIZE = 1024 * 1024
 
-def download_asset(build_url, url_path, file_name, output_path, gz=True):
+# zlib window bits for decoding gzip headers and trailers
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+# checksum.json hex digest length -> hash algorithm
+CHECKSUM_ALGORITHMS = { 32: "md5", 40: "sha1", 64: "sha256" }
+
+# HTTP errors which may succeed when retried
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+
+class IncompleteDownload(Exception):
+    """ The connection ended before the whole file was received, the download can be resumed """
+
+
+class ChecksumError(Exception):
+    """ A downloaded file doesn't match its checksum or size from `checksum.json` """
+
+
+# errors which fail a download attempt
+DOWNLOAD_ERRORS = (
+    requests.RequestException,
+    urllib3.exceptions.HTTPError,
+    ConnectionError,
+    EOFError,
+    zlib.error,
+    IncompleteDownload,
+    ChecksumError,
+)
+
+
+def create_session(pool_size=Constants.DOWNLOAD_WORKERS):
+    """ Creates a `requests.Session` which keeps up to `pool_size` connections per host alive between downloads """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class GzipDecoder:
+    """ Decompresses gzipped data passed in chunks. Supports multi-member gzip files. """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.member_started = False
+
+    def decompress(self, chunk):
+        data = []
+        while chunk:
+            if self.decompressor.eof:
+                # a new gzip member starts after the end of the previous one
+                self.decompressor = zlib.decompressobj(GZIP_WBITS)
+
+            self.member_started = True
+            data.append(self.decompressor.decompress(chunk))
+            chunk = self.decompressor.unused_data
+
+        return b"".join(data)
+
+    def flush(self):
+        data = self.decompressor.flush()
+        if self.member_started and not self.decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+        return data
+
+
+class DownloadState:
+    """
+    What has been received of a file by `stream_asset`, kept between the attempts of `fetch_asset` so they resume with a Range request.
+    The received data is extracted (if gzipped) and hashed as it arrives, so only the extracted file is written to disk.
+    The decompressor and hashes are only kept in memory, so a build which is restarted downloads the file again.
+    """
+
+    def __init__(self, output_file: Path, gz, checksum=None):
+        self.output_file = output_file
+        self.gz = gz
+        self.checksum = checksum
+        self.reset()
+
+    def reset(self):
+        """ Starts the file over """
+
+        # never write through an existing hardlink into the download cache
+        remove_path(self.output_file)
+
+        self.received = 0
+        self.decoder = GzipDecoder() if self.gz else None
+        self.raw_hasher = checksum_hasher(self.checksum) if self.gz else None
+        self.hasher = checksum_hasher(self.checksum)
+
+    def write(self, file, chunk):
+        """ Writes a received chunk to `file`, extracting and hashing it """
+
+        self.received += len(chunk)
+        if self.raw_hasher is not None:
+            self.raw_hasher.update(chunk)
+
+        if self.decoder is not None:
+            chunk = self.decoder.decompress(chunk)
+
+        self.write_data(file, chunk)
+
+    def finish(self, file):
+        """ Writes the end of the extracted data, once the whole file was received """
+        if self.decoder is not None:
+            self.write_data(file, self.decoder.flush())
+
+    def write_data(self, file, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+        file.write(data)
+
+    def digests(self):
+        """ Returns the hex digests of the extracted file and of the file as sent by the CDN """
+        return [hasher.hexdigest() for hasher in (self.hasher, self.raw_hasher) if hasher is not None]
+
+
+def fetch_asset(build_url, url_path, file_name, output_path, gz=True, session=None, checksum=None, size=None, retries=Constants.DOWNLOAD_RETRIES):
     """
     Downloads a build asset, automatically extracting the file if it was gzipped.
+    Failed downloads are retried with a backoff, resuming from where they stopped with a Range request (see `DownloadState`).
+    If the file doesn't match its `checksum`/`size`, it's downloaded again from the start.
+    Raises one of `DOWNLOAD_ERRORS` once every attempt failed.
+    Returns a tuple of (output_file, file_size, elapsed_seconds).
 
     Paramaters
     build_url   -- The url of the CDN to use (example `AppSettings.BuildCDN`)
     url_path    -- The url path to the asset, excluding the filename
     file_name   -- The file name
-    output_path  -- The output directory of the file. Default is "./temp"
+    output_path -- The output directory of the file. Default is "./temp"
     gz          -- If the file is stored on the CDN as a gzipped archive, and should be extracted. Default is True
+    session     -- The `requests.Session` to download with, so connections can be reused. Default is a new connection
+    checksum    -- The md5/sha1/sha256 hex digest of the (extracted) file from `checksum.json`. Default is unverified
+    size        -- The size of the (extracted) file from `checksum.json`. Default is unverified
+    retries     -- The number of times a failed download is retried
     """
 
     ext = ""
@@ -43,35 +177,148 @@ def download_asset(build_url, url_path, file_name, output_path, gz=True):
     output_file: Path = output_path / file_name
 
     logger.log(logging.DEBUG, f"Downloading {download_url}")
+    start_time = perf_counter()
+
+    http = session or requests
+    state = DownloadState(output_file, gz, checksum)
+    for attempt in range(retries + 1):
+        try:
+            stream_asset(http, download_url, state, size)
+            break
+        except (ChecksumError, zlib.error) as e:
+            # the downloaded data is wrong, start over
+            state.reset()
+            error = e
+        except DOWNLOAD_ERRORS as e:
+            if isinstance(e, HTTPError) and e.response.status_code not in RETRY_STATUS_CODES:
+                raise
+            error = e
+
+        if attempt == retries:
+            raise error
+
+        delay = Constants.DOWNLOAD_BACKOFF * 2 ** attempt * random.uniform(0.5, 1)
+        logger.log(logging.WARNING, f"Error downloading {file_name} ({error!r}), retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+        metrics.count("download_retries")
+        sleep(delay)
+
+    elapsed = perf_counter() - start_time
+    return (output_file, output_file.stat().st_size, elapsed)
+
+
+def stream_asset(http, download_url, state: DownloadState, size=None):
+    """
+    Makes a single attempt at downloading a file for `fetch_asset`, continuing from what `state` has received.
+    The `checksum` and `size` may be of either the extracted file or the file as sent by the CDN.
+    Raises `IncompleteDownload` if the response ended early, or `ChecksumError` if the file doesn't match.
+    """
+
+    offset = state.received
+    headers = { "Range": f"bytes={offset}-" } if offset > 0 else {}
+
+    with http.get(download_url, stream=True, timeout=60, headers=headers) as response:
+        # the file is shorter than what was received, it can't be continued
+        if response.status_code == 416:
+            state.reset()
+            raise IncompleteDownload(f"Range {offset}- not satisfiable, restarting")
+
+        response.raise_for_status()
+
+        # the server ignored the Range header, the whole file is sent again
+        if offset > 0 and response.status_code != 206:
+            state.reset()
+            offset = 0
+        elif offset > 0:
+            logger.log(logging.DEBUG, f"Resuming {state.output_file.name} from {format_size(offset)}")
+            metrics.count("download_resumed_bytes", offset)
+
+        expected_size = response_size(response, offset)
+
+        with open(state.output_file, "ab") as file:
+            # read the raw stream, the CDN's .gz files must not be decoded by requests
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                state.write(file, chunk)
+
+            if expected_size is not None and state.received < expected_size:
+                raise IncompleteDownload(f"Received {state.received} of {expected_size} bytes")
+
+            state.finish(file)
+
+    file_size = state.output_file.stat().st_size
+    if size is not None and int(size) not in (file_size, state.received):
+        raise ChecksumError(f"Expected {size} bytes, got {file_size} bytes")
+
+    digests = state.digests()
+    if digests and state.checksum.lower() not in digests:
+        raise ChecksumError(f"Expected checksum {state.checksum.lower()}, got {digests[0]}")
+
+
+def response_size(response, offset):
+    """ Returns the size of the whole file being downloaded, from the Content-Range or Content-Length header, or None if unknown """
+
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code == 206 and "/" in content_range:
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+
+    content_length = response.headers.get("Content-Length", "")
+    return offset + int(content_length) if content_length.isdigit() else None
+
+
+def checksum_hasher(checksum):
+    """ Returns the `hashlib` hash matching a hex digest by its length (md5, sha1 or sha256), or None if there isn't one """
+
+    if not checksum:
+        return None
+
+    algorithm = CHECKSUM_ALGORITHMS.get(len(checksum))
+    if algorithm is None:
+        return None
+
+    return hashlib.new(algorithm)
+
+
+def download_asset(build_url, url_path, file_name, output_path, gz=True, session=None):
+    """ Downloads a build asset using `fetch_asset`. Returns True if the file was downloaded. """
 
     try:
-        urllib.request.urlretrieve(download_url, f"{output_file}{ext}")
+        output_file, file_size, elapsed = fetch_asset(build_url, url_path, file_name, output_path, gz, session)
     except HTTPError as e:
-        logger.log(logging.ERROR, f"Error downloading \"{download_url}\". Error: {e.code} {e.msg}")
+        logger.log(logging.ERROR, f"Error downloading \"{e.request.url}\". Error: {e.response.status_code} {e.response.reason}")
+        return False
+    except DOWNLOAD_ERRORS as e:
+        logger.log(logging.ERROR, f"Error downloading {file_name}. Error: {e!r}")
         return False
 
-    if gz:
-        logger.log(logging.DEBUG, f"Extracting {file_name}{ext}")
-        with gzip.open(f"{output_file}{ext}", "rb") as f_in:
-            with open(output_file, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-        os.remove(f"{output_file}{ext}")
-
-    logger.log(logging.INFO, f"Downloaded {file_name}")
+    logger.log(logging.INFO, f"Downloaded {output_file.name} ({format_size(file_size)} in {elapsed:.2f}s)")
     return output_file.exists()
 
 
-def download_client_assets(build_url, output_path):
-    """ Downloads all the client assets, and automatically extracts gzipped files """
+def download_client_assets(build_url, output_path, workers=Constants.DOWNLOAD_WORKERS, cache: DownloadCache = None):
+    """
+    Downloads all the client assets, and automatically extracts gzipped files.
+    Files are downloaded by `workers` threads sharing a pool of keep-alive connections.
+    Files whose checksum is already in the download `cache` are linked from it instead of downloaded.
+    Each file is retried on its own (see `fetch_asset`). Returns None if a file still couldn't be downloaded.
+    """
 
-    logger.log(logging.INFO, "Downloading client build assets...")
+    logger.log(logging.INFO, f"Downloading client build assets... ({workers} workers)")
     IndentFilter.level += 1
 
+    session = create_session(workers)
+    if cache is None:
+        cache = DownloadCache()
+
     checksum_file = output_path / "checksum.json"
-    download_asset(build_url, "/", "checksum.json", output_path, gz=False)
+    if not download_asset(build_url, "/", "checksum.json", output_path, gz=False, session=session):
+        session.close()
+        IndentFilter.level -= 1
+        return None
+
     checksum_data = read_json(checksum_file)
-    
+
+    downloads = []
+    cached = 0
     for file in checksum_data["files"]:
         file_name = ntpath.basename(file["file"])
         file_dir = ntpath.dirname(file["file"])
@@ -84,9 +331,67 @@ def download_client_assets(build_url, output_path):
         else:
             file_dir = "/" + file_dir + "/"
 
-        download_asset(build_url, file_dir, file_name, output_file_dir, gz=True)
+        checksum = file.get("checksum")
+        if cache.get(checksum, output_file_dir / file_name):
+            cached += 1
+            continue
+
+        downloads.append((file["file"], file_dir, file_name, output_file_dir, checksum, file.get("size")))
+
+    logger.log(logging.INFO, f"{cached} files unchanged (linked from cache), {len(downloads)} files to download")
+    metrics.count("cache_hits", cached, cache="download")
+    metrics.count("cache_misses", len(downloads), cache="download")
+
+    start_time = perf_counter()
+    total_size = 0
+    done = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # each download runs in a copy of the current context, so its retries are logged and counted for this build
+        futures = {
+            executor.submit(contextvars.copy_context().run, fetch_asset, build_url, file_dir, file_name, output_file_dir, True, session, checksum, size): (file, checksum)
+            for file, file_dir, file_name, output_file_dir, checksum, size in downloads
+        }
+
+        for future in as_completed(futures):
+            done += 1
+            file, checksum = futures[future]
+
+            try:
+                output_file, file_size, elapsed = future.result()
+            except HTTPError as e:
+                logger.log(logging.ERROR, f"[{done}/{len(downloads)}] Error downloading \"{e.request.url}\". Error: {e.response.status_code} {e.response.reason}")
+                failed += 1
+                continue
+            except DOWNLOAD_ERRORS as e:
+                logger.log(logging.ERROR, f"[{done}/{len(downloads)}] Error downloading {file}. Error: {e!r}")
+                failed += 1
+                continue
+
+            # only files matching their checksum get here, so the cache is never given a bad file
+            cache.add(checksum, output_file)
+            metrics.count("downloaded_files")
+            metrics.count("downloaded_bytes", file_size)
+
+            total_size += file_size
+            speed = file_size / elapsed if elapsed > 0 else 0
+            logger.log(logging.INFO, f"[{done}/{len(downloads)}] Downloaded {file} ({format_size(file_size)} in {elapsed:.2f}s, {format_size(speed)}/s)")
+
+    session.close()
+    cache.evict()
+
+    elapsed = perf_counter() - start_time
+    speed = total_size / elapsed if elapsed > 0 else 0
+    logger.log(logging.INFO, f"Downloaded {len(downloads) - failed} files ({format_size(total_size)} in {elapsed:.2f}s, {format_size(speed)}/s)")
 
     IndentFilter.level -= 1
+
+    # the files downloaded so far are cached, so retrying the build continues from here
+    if failed > 0:
+        logger.log(logging.ERROR, f"{failed} files could not be downloaded")
+        return None
+
     return output_path
 
 
@@ -100,7 +405,10 @@ def download_launcher_assets(build_url, build_id, output_path):
     installer_downloaded = download_asset(build_url, "", ".exe", output_path, gz=False)
     if installer_downloaded:
         launcher_file = build_id + ".exe"
-        unpack_launcher_assets(output_path / launcher_file, output_path)
+        if not unpack_launcher_assets(output_path / launcher_file, output_path):
+            logger.log(logging.ERROR, "Failed to unpack the launcher exe")
+            IndentFilter.level -= 1
+            return None
 
         # outputted directories by the unpacker
         IndentFilter.level -= 1
@@ -1,21 +1,66 @@
+import io
 import logging
 import os
+import hashlib
 import json
-import subprocess
 import re as regex
 import ntpath
 import UnityPy
+from UnityPy.enums import ClassIDType, SpritePackingMode, SpritePackingRotation
+from UnityPy.export.SpriteHelper import get_triangles
+from UnityPy.export.Texture2DConverter import get_image_from_texture2d
+from PIL import Image, ImageDraw
 import requests
 import shutil
 from pathlib import Path
+from collections import Counter
+from time import perf_counter
+import threading
+from threading import BoundedSemaphore
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 # from xml.etree import ElementTree
 
 from classes import Constants
-from classes import logger, IndentFilter
+from classes import logger, IndentFilter, BufferHandler, ExtractCache, TextureCache, metrics, tools, DETAIL
 from functions.File import *
-
-
-def extract_unity_assets(input_dir, output_path):
+from functions.Metadata import *
+from functions.XmlDatabase import *
+
+# objects which are decoded/converted when extracted, and are worth caching
+CACHED_TYPES = ["TextAsset", "Sprite", "Texture2D", "AudioClip"]
+
+# images are overwritten by later images with the same name, other duplicates are renamed
+IMAGE_TYPES = ["Sprite", "Texture2D"]
+
+# how a packed sprite is rotated in its texture, as UnityPy reads it
+SPRITE_ROTATIONS = {
+    SpritePackingRotation.kSPRFlipHorizontal: Image.FLIP_TOP_BOTTOM,
+    SpritePackingRotation.kSPRFlipVertical: Image.FLIP_LEFT_RIGHT,
+    SpritePackingRotation.kSPRRotate180: Image.ROTATE_180,
+    SpritePackingRotation.kSPRRotate90: Image.ROTATE_270,
+}
+
+# change to invalidate the extraction cache, e.g. if the output format changes
+EXTRACT_CACHE_VERSION = 1
+
+# Il2CppInspector flags, and the output flags with the file/directory they write to
+IL2CPP_DUMP_FLAGS = ["--layout", "class", "--select-outputs"]
+IL2CPP_DUMP_OUTPUTS = [
+    ("--py-out",   "il2cpp.py"),
+    ("--json-out", "metadata.json"),
+    ("--cs-out",   "types"),
+    ("--cpp-out",  "cpp"),
+]
+
+
+def extract_unity_assets(input_dir, output_path, manifest_file: Path = None, workers=Constants.EXTRACT_WORKERS):
+    """
+    Extracts the assets of every Unity file in the build's `_Data` directory.
+    Each file is extracted into a separate directory, which is merged into `output_path` in file name order,
+    so duplicate names are resolved the same way with any number of workers (see `merge_assets`).
+    With more than one worker, the files are extracted by a process pool and their logs are merged in the same order.
+    If `manifest_file` is given, an entry for every extracted file is written to it (see `write_manifest`).
+    """
 
     file_patterns = [
         "^globalgamemanagers",
@@ -36,7 +81,8 @@ def extract_unity_assets(input_dir, output_path):
     data_dir = find_path(input_dir, "*_Data")
 
     # Iterate files
-    for file_name in os.listdir(data_dir):
+    file_paths = []
+    for file_name in sorted(os.listdir(data_dir)):
         file_path = os.path.join(data_dir, file_name)
 
         if not os.path.isfile(file_path):
@@ -58,21 +104,131 @@ def extract_unity_assets(input_dir, output_path):
         if not continue_loop:
             continue
 
-        extract_assets(file_path, output_path)
+        file_paths.append(file_path)
+
+    manifest = []
+    if workers <= 1:
+        parts_dir = output_path / ".parts"
+        for file_path in file_paths:
+            file_output_path = parts_dir / Path(file_path).name
+            entries = extract_assets(file_path, file_output_path)
+            manifest += merge_assets(file_output_path, output_path, entries)
+
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    else:
+        manifest = extract_assets_parallel(file_paths, output_path, workers)
+
+    # an overwritten image only keeps the entry of the last object written to it
+    manifest = list({ entry["path"]: entry for entry in manifest }.values())
+
+    for entry in manifest:
+        metrics.count("extracted_files", type=entry["type"])
+        metrics.count("written_bytes", entry["size"], stage="extract_unity")
+
+    if manifest_file is not None:
+        write_manifest(manifest_file, manifest)
 
     IndentFilter.level -= 1
     logger.log(logging.INFO, "Build assets extracted!")
 
 
-def extract_assets(file_path, output_path):
+def extract_assets_parallel(file_paths, output_path, workers):
+    """
+    Extracts each asset file in a process pool, then merges the outputs and logs in the order of `file_paths`.
+    Returns the merged manifest entries.
+    """
+
+    logger.log(logging.INFO, f"Extracting {len(file_paths)} files with {workers} processes")
+
+    parts_dir = output_path / ".parts"
+    manifest = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=logger.initWorker) as executor:
+        futures = [
+            executor.submit(extract_assets_worker, file_path, parts_dir / Path(file_path).name)
+            for file_path in file_paths
+        ]
+
+        # wait in submission order, so the merged output doesn't depend on which file finishes first
+        for file_path, future in zip(file_paths, futures):
+            try:
+                records, file_output_path, entries, counters = future.result()
+            except Exception as e:
+                logger.log(logging.ERROR, f"Error extracting assets from \"{Path(file_path).name}\". Error: {e}")
+                continue
+
+            logger.replay(records)
+            metrics.merge(counters)
+            manifest += merge_assets(file_output_path, output_path, entries)
+
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return manifest
+
+
+def merge_assets(file_output_path: Path, output_path: Path, entries):
+    """
+    Moves the assets extracted from one file into `output_path`. Duplicate images are overwritten, other duplicates are renamed.
+    Returns the entries with their new paths.
+    """
+
+    if not file_output_path.exists():
+        return []
+
+    renamed = merge_dirs(file_output_path, output_path, overwrite_dirs=IMAGE_TYPES)
+    for entry in entries:
+        path = Path(entry["path"])
+        entry["path"] = renamed.get(path, path).as_posix()
+
+    return entries
+
+
+def extract_assets_worker(file_path, output_path):
+    """
+    Runs `extract_assets` inside a worker process.
+    Returns the captured log records, the output directory, the manifest entries and the metrics counters.
+    """
+
+    handler = BufferHandler()
+    logger.logger.handlers = [handler]
+    logger.logger.setLevel(logger.level())
+
+    worker_metrics = metrics.start()
+    entries = extract_assets(file_path, output_path)
+    return (handler.records, output_path, entries, worker_metrics.counters)
+
+
+def extract_assets(file_path, output_path, cache: ExtractCache = None):
+    """
+    Extracts the assets of a single Unity file. Returns a manifest entry for every file written.
+    Objects found in the extraction `cache` are linked from a previous build instead of being decoded.
+    """
 
     file_name = Path(file_path).name
     logger.log(logging.INFO, f"Extracting assets from \"{file_name}\"")
     IndentFilter.level += 1
+    start_time = perf_counter()
 
+    # a line is logged per object unless the verbosity is "summary", then only the counts per type
+    log_objects = logger.isEnabledFor(DETAIL)
     obj_type_len = 0  # 13
     obj_name_len = 0  # 35
-    path_id_len = 0  # 6
+    type_counts = Counter()
+
+    # decoded images are encoded to png in a thread pool, while the next objects are read
+    # the semaphore blocks the object walk when too many images are waiting, to cap memory usage
+    encode_pool = ThreadPoolExecutor(max_workers=Constants.ENCODE_WORKERS)
+    encode_slots = BoundedSemaphore(Constants.ENCODE_QUEUE_SIZE)
+    encode_jobs = []
+    encoding_files = {}
+    manifest = []
+
+    if cache is None:
+        cache = ExtractCache()
+
+    cache_hits = Counter()
+    cache_misses = Counter()
+    texture_keys = {}
+    # textures are only shared within an asset file, so the cache (and its memory budget) is per worker
+    textures = TextureCache()
 
     env = UnityPy.load(file_path)
     for obj in env.objects:
@@ -88,7 +244,24 @@ def extract_assets(file_path, output_path):
         if obj_name == "":
             obj_name = "Untitled"
 
-        if obj.type == "TextAsset":
+        cache_key = None
+        cached_outputs = None
+        if str(obj.type) in CACHED_TYPES:
+            cache_key = object_cache_key(obj, data, texture_keys)
+            if cache_key is not None:
+                cached_outputs = cache.get(cache_key)
+
+        cached_entries = None
+        if cached_outputs is not None:
+            cached_entries = link_cached_outputs(cache, cached_outputs, output_path, obj, file_name, encoding_files)
+
+        if cached_entries is not None:
+            cache_hits[str(obj.type)] += 1
+            manifest += cached_entries
+            if cached_entries:
+                output_file = output_path / cached_entries[-1]["path"]
+
+        elif obj.type == "TextAsset":
             first_line = data.text.partition("\n")[0]
 
             ext = "txt"
@@ -100,7 +273,12 @@ def extract_assets(file_path, output_path):
                 ext = "json"
 
             output_file = output_path / str(obj.type) / f"{obj_name}.{ext}"
-            write_file(output_file, data.m_Script, "wb")
+            output_name = output_file.name
+            output_file = write_file(output_file, data.m_Script, "wb")
+
+            entry = manifest_entry(output_path, output_file, obj, file_name)
+            manifest.append(entry)
+            cache_result(cache, cache_key, cache_misses, obj, [cache_output(output_name, entry)])
 
         elif obj.type == "Sprite" or obj.type == "Texture2D":
             # print pathid or something like that here
@@ -108,14 +286,31 @@ def extract_assets(file_path, output_path):
             Path(output_file).parent.mkdir(parents=True, exist_ok=True)
 
             try:
-                data.image.save(output_file)
+                image = decode_image(obj, data, textures)
             except Exception as e:
                 logger.log(logging.ERROR, f"Error saving {str(obj.type)} \"{obj_name}\" (Path ID: {obj.path_id} in {file_name}) Error: {e}")
+            else:
+                # an image with the same name is overwritten, so it must be written first
+                wait_for_encode(encoding_files, output_file)
+
+                encode_slots.acquire()
+                future = encode_pool.submit(save_image, image, output_file, encode_slots)
+                encoding_files[output_file] = future
+                entry = manifest_entry(output_path, output_file, obj, file_name, hashed=False)
+                manifest.append(entry)
+                encode_jobs.append((future, entry, obj_name, cache_key))
 
         elif obj.type == "AudioClip":
+            outputs = []
             for name, data in data.samples.items():
                 output_file = output_path / str(obj.type) / name
-                write_file(output_file, data, "wb")
+                output_file = write_file(output_file, data, "wb")
+
+                entry = manifest_entry(output_path, output_file, obj, file_name)
+                manifest.append(entry)
+                outputs.append(cache_output(name, entry))
+
+            cache_result(cache, cache_key, cache_misses, obj, outputs)
 
         elif obj.type == "MonoScript":
 
@@ -130,32 +325,285 @@ def extract_assets(file_path, output_path):
 
             json_pretty = json.dumps(base, indent=4)
 
-            write_file(output_file, json_pretty, "w")
+            output_file = write_file(output_file, json_pretty, "w")
+            manifest.append(manifest_entry(output_path, output_file, obj, file_name))
 
 
         if output_file != "":
+            type_counts[str(obj.type)] += 1
+
+            if log_objects:
+                if len(str(obj.type)) > obj_type_len:
+                    obj_type_len = len(str(obj.type)) + 1
+                if len(obj_name) > obj_name_len:
+                    obj_name_len = len(obj_name) + 1
+
+                # formatted by the logging thread
+                logger.log(DETAIL, "%-*s %-*s (Path ID: %s)", obj_name_len, obj_name, obj_type_len, obj.type, obj.path_id)
+
+    encode_pool.shutdown(wait=True)
+    for future, entry, obj_name, cache_key in encode_jobs:
+        e = future.exception()
+        if e is not None:
+            logger.log(logging.ERROR, f"Error saving {entry['type']} \"{obj_name}\" (Path ID: {entry['path_id']} in {file_name}) Error: {e}")
+            continue
 
-            # logger.log(logging.INFO, f"{str(obj.type)} {obj_name} {obj.path_id} {file_name}")
-            # logger.log(logging.INFO, f"{str(obj.type):<13} {obj_name:<35} {obj.path_id:<6} {file_name}")
+        entry["hash"], entry["size"] = future.result()
+        if cache_key is not None:
+            cache_misses[entry["type"]] += 1
+            cache.put(cache_key, [cache_output(f"{obj_name}.png", entry)])
+
+    for obj_type in CACHED_TYPES:
+        metrics.count("cache_hits", cache_hits[obj_type], cache="extract", type=obj_type)
+        metrics.count("cache_misses", cache_misses[obj_type], cache="extract", type=obj_type)
+
+        if cache_hits[obj_type] + cache_misses[obj_type] > 0:
+            logger.log(logging.INFO, f"{obj_type} cache: {cache_hits[obj_type]} hits, {cache_misses[obj_type]} misses")
+
+    metrics.count("cache_hits", textures.hits, cache="texture")
+    metrics.count("cache_misses", textures.misses, cache="texture")
+    if textures.misses > 0:
+        logger.log(
+            logging.INFO,
+            f"Texture cache: {textures.misses} textures decoded, {textures.hits} reused, {textures.evictions} evicted (peak {format_size(textures.peak_size)})"
+        )
+
+    # leave out the images which failed to save, and the entries of overwritten images
+    manifest = [entry for entry in manifest if entry["hash"] is not None]
+    manifest = list({ entry["path"]: entry for entry in manifest }.values())
+
+    elapsed = perf_counter() - start_time
+    total = sum(type_counts.values())
+    if total > 0:
+        written = sum(entry["size"] for entry in manifest)
+        types = ", ".join(f"{count} {obj_type}" for obj_type, count in type_counts.most_common())
+        logger.log(
+            logging.INFO,
+            f"Extracted {total} objects ({types}) in {elapsed:.2f}s, {total / max(elapsed, 1e-9):.0f} objects/s, {format_size(written / max(elapsed, 1e-9))}/s"
+        )
 
-            if len(str(obj.type)) > obj_type_len:
-                obj_type_len = len(str(obj.type)) + 1
-            if len(obj_name) > obj_name_len:
-                obj_name_len = len(obj_name) + 1
-            if len(str(obj.path_id)) > path_id_len:
-                path_id_len = len(str(obj.path_id)) + 2
+    IndentFilter.level -= 1
+    return manifest
 
-            logger.log(logging.INFO, "{:<{}} {:<{}} {:<{}}".format(
-                obj_name, obj_name_len,
-                str(obj.type), obj_type_len,
-                f"(Path ID: {obj.path_id})", path_id_len
-            ))
 
-    IndentFilter.level -= 1
+def link_cached_outputs(cache: ExtractCache, cached_outputs, output_path, obj, file_name, encoding_files):
+    """
+    Links the cached outputs of an object into `output_path`. Returns their manifest entries,
+    or None if a file was removed from the store since it was looked up, then the object is extracted again.
+    """
+
+    entries = []
+    for output in cached_outputs:
+        output_file = output_path / str(obj.type) / output["name"]
+
+        # images are overwritten, other types are renamed like `write_file` does
+        if str(obj.type) in IMAGE_TYPES:
+            wait_for_encode(encoding_files, output_file)
+        else:
+            output_file = rename_duplicate_file(output_file)
+
+        if not cache.link(output, output_file):
+            logger.log(logging.DEBUG, f"{output['name']} was removed from the cache, extracting it again")
+            for entry in entries:
+                remove_path(output_path / entry["path"])
+            return None
+
+        entry = manifest_entry(output_path, output_file, obj, file_name, hashed=False)
+        entry["hash"], entry["size"] = output["hash"], output["size"]
+        entries.append(entry)
+
+    return entries
+
+
+def wait_for_encode(encoding_files, output_file):
+    """ Waits until an image being encoded to `output_file` is written, so images are overwritten in object order """
+
+    future = encoding_files.pop(output_file, None)
+    if future is not None:
+        future.exception()
+
+
+def object_cache_key(obj, data, texture_keys):
+    """
+    Returns the extraction cache key of an object, a sha256 hash of its serialized data.
+    Data stored outside the object (texture/audio streams, a sprite's textures) is included.
+    Returns None if the object can't be cached.
+    """
+
+    sha256 = hashlib.sha256()
+    sha256.update(f"{EXTRACT_CACHE_VERSION}:{obj.type}:".encode("utf-8"))
+
+    try:
+        sha256.update(obj.get_raw_data())
+
+        if obj.type == "Texture2D":
+            sha256.update(texture_key(obj, data, texture_keys).encode("utf-8"))
+
+        elif obj.type == "Sprite":
+            # a sprite is cropped from its texture, so it changes when the texture does
+            for texture in [data.m_RD.texture, data.m_RD.alphaTexture]:
+                if texture.path_id == 0:
+                    continue
+
+                texture_data = texture.read()
+                sha256.update(texture_key(texture_data.reader, texture_data, texture_keys).encode("utf-8"))
+
+        elif obj.type == "AudioClip":
+            sha256.update(data.m_AudioData or b"")
+
+    except Exception as e:
+        logger.log(logging.DEBUG, f"Unable to create a cache key for {obj.type} (Path ID: {obj.path_id}). Error: {e}")
+        return None
+
+    return sha256.hexdigest()
+
+
+def texture_key(obj, data, texture_keys):
+    """ Returns the hash of a texture's pixel data. Hashes are kept in `texture_keys`, as textures are shared by many sprites. """
+
+    cache_id = (obj.assets_file.name, obj.path_id)
+    if cache_id not in texture_keys:
+        texture_keys[cache_id] = hashlib.sha256(data.image_data or b"").hexdigest()
+
+    return texture_keys[cache_id]
+
+
+def cache_output(name, entry):
+    return { "name": name, "hash": entry["hash"], "size": entry["size"] }
+
+
+def cache_result(cache, cache_key, cache_misses, obj, outputs):
+    """ Stores the outputs of an extracted object in the extraction cache """
+    if cache_key is None:
+        return
+
+    cache_misses[str(obj.type)] += 1
+    cache.put(cache_key, outputs)
+
+
+def decode_image(obj, data, textures: TextureCache):
+    """
+    Decodes a Texture2D or Sprite. Decoded textures are kept in `textures`, so each texture is decoded once
+    for itself and every sprite cropped from it.
+    """
+
+    if obj.type == "Sprite":
+        return sprite_image(data, textures)
+
+    # the cached texture is upside down like Unity stores it, which is what the sprites are cropped from
+    return texture_image(data, None, textures).transpose(Image.FLIP_TOP_BOTTOM)
+
+
+def texture_image(texture, alpha_texture, textures: TextureCache):
+    """
+    Returns a decoded texture, upside down, with the red channel of `alpha_texture` as its alpha channel if given.
+    Textures are keyed by their own asset file and path id, as a sprite's texture may be in another file (e.g. sharedassets).
+    """
+
+    key = (texture.assets_file.name, texture.path_id)
+    if alpha_texture is not None:
+        key += (alpha_texture.assets_file.name, alpha_texture.path_id)
+
+    image = textures.get(key)
+    if image is None:
+        image = get_image_from_texture2d(texture, False)
+        if alpha_texture is not None:
+            alpha_image = get_image_from_texture2d(alpha_texture, False)
+            image = Image.merge("RGBA", (*image.split()[:3], alpha_image.split()[0]))
+
+        textures.put(key, image)
+
+    return image
+
+
+def sprite_image(sprite, textures: TextureCache):
+    """ Crops a sprite from its decoded texture in `textures`, the same way as UnityPy's `Sprite.image` """
+
+    atlas = None
+    if sprite.m_SpriteAtlas:
+        atlas = sprite.m_SpriteAtlas.read()
+    elif sprite.m_AtlasTags:
+        # the atlas isn't referenced, look it up by name
+        for obj in sprite.assets_file.objects.values():
+            if obj.type == ClassIDType.SpriteAtlas:
+                atlas = obj.read()
+                if atlas.name == sprite.m_AtlasTags[0]:
+                    break
+                atlas = None
+
+    render_data = atlas.m_RenderDataMap[sprite.m_RenderDataKey] if atlas else sprite.m_RD
+
+    alpha_texture = None
+    if render_data.alphaTexture and getattr(render_data.alphaTexture, "type", ClassIDType.UnknownType) == ClassIDType.Texture2D:
+        alpha_texture = render_data.alphaTexture.read()
+
+    image = texture_image(render_data.texture.read(), alpha_texture, textures)
+
+    rect = render_data.textureRect
+    image = image.crop((rect.x, rect.y, rect.x + rect.width, rect.y + rect.height))
+
+    settings = render_data.settingsRaw
+    if settings.packed == 1 and settings.packingRotation in SPRITE_ROTATIONS:
+        image = image.transpose(SPRITE_ROTATIONS[settings.packingRotation])
+
+    if settings.packingMode == SpritePackingMode.kSPMTight:
+        # keep only the sprite's polygon
+        mask = Image.new("1", image.size, color=0)
+        draw = ImageDraw.ImageDraw(mask)
+        for triangle in get_triangles(sprite):
+            draw.polygon(triangle, fill=1)
+
+        if image.mode == "RGBA":
+            image = Image.composite(image, Image.new(image.mode, image.size, color=0), mask)
+        else:
+            image.putalpha(mask)
+
+    return image.transpose(Image.FLIP_TOP_BOTTOM)
+
+
+def save_image(image, output_file, encode_slots):
+    """ Encodes and saves an image as png, then frees its slot in the encode queue. Returns the sha256 hash and size of the file. """
+    try:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        data = buffer.getvalue()
+
+        replace_file(output_file, data, "wb")
+
+        return (hashlib.sha256(data).hexdigest(), len(data))
+    finally:
+        encode_slots.release()
+
+
+def manifest_entry(output_path: Path, output_file: Path, obj, source_file, hashed=True):
+    """ Creates the manifest entry of an extracted file. With `hashed=False` the hash and size are filled in later. """
+
+    entry = {
+        "path": output_file.relative_to(output_path).as_posix(),
+        "hash": None,
+        "size": None,
+        "type": str(obj.type),
+        "path_id": obj.path_id,
+        "source": source_file,
+    }
+
+    if hashed:
+        with open(output_file, "rb") as file:
+            data = file.read()
+
+        entry["hash"] = hashlib.sha256(data).hexdigest()
+        entry["size"] = len(data)
+
+    return entry
 
 
 def extract_exalt_version(metadata_file: Path, output_file: Path):
-    """ Attempts to find the current version string (e.g. `1.3.2.0.0`) located in `global-metadata.dat` """
+    """
+    Attempts to find the current version string (e.g. `1.3.2.0.0`) located in `global-metadata.dat`.
+    Returns a tuple of (version_string, string_literal_index), the version being "" if it couldn't be found.
+    The index is a dict of string literal -> index in the metadata (see `index_string_literals`),
+    or None if the metadata header couldn't be parsed.
+    """
 
     # TODO: Decode/decrypt build version from appsettings
 
@@ -167,32 +615,77 @@ def extract_exalt_version(metadata_file: Path, output_file: Path):
     # string using the previous const strings in the class to get the correct
     # one. (Which is 127.0.0.1 - see the class KFFELHLKACG)
 
+    # The metadata file is memory-mapped and its header parsed, so that only the
+    # string literal table and the const (default value) data are searched.
+    # The whole file is only scanned if the header can't be parsed.
+
     # For testing:
     # cat global-metadata.dat | grep --text -Po "127\.0\.0\.1[\x00-\x20]*(\d(?:\.\d){4})"
 
     logger.log(logging.INFO, "Attempting to extract Exalt version string")
     IndentFilter.level += 1
 
-    pattern = regex.compile(b"127\.0\.0\.1[\x00-\x20]*(\d(?:\.\d){4})")
+    results = set()
+    string_literal_index = None
+
+    # an empty file can't be memory-mapped, and has no version
+    if Path(metadata_file).stat().st_size > 0:
+        with open_metadata(metadata_file) as data:
+            results, string_literal_index = find_exalt_version(data)
 
     version_string = ""
-    with open(metadata_file, "rb") as file:
-        data = file.read()
-        result = pattern.findall(data)
-
-        if len(result) == 1:
-            version_string = result[0].decode("utf-8")
-            logger.log(logging.INFO, f"Exalt version is \"{version_string}\"")
-            write_file(output_file, version_string)
-        else:
-            logger.log(logging.INFO, "Could not extract version string! Must be manually updated.")
-            write_file(output_file, "")
+    if len(results) == 1:
+        version_string = results.pop().decode("utf-8")
+        logger.log(logging.INFO, f"Exalt version is \"{version_string}\"")
+        write_file(output_file, version_string)
+    else:
+        logger.log(logging.INFO, "Could not extract version string! Must be manually updated.")
+        write_file(output_file, "")
 
     IndentFilter.level -= 1
-    return version_string
+    return (version_string, string_literal_index)
+
+
+def find_exalt_version(data):
+    """
+    Searches the metadata `data` for `extract_exalt_version`.
+    Returns a tuple of (the set of version strings found, as bytes; the string literal index, or None).
+    """
+
+    pattern = regex.compile(b"127\.0\.0\.1[\x00-\x20]*(\d(?:\.\d){4})")
+    version_pattern = regex.compile(r"^\d(?:\.\d){4}$")
+
+    results = set()
+    string_literal_index = None
+    header = read_metadata_header(data)
+
+    if header is not None:
+        logger.log(logging.DEBUG, f"Metadata version {header['version']}")
+        string_literals = read_string_literals(data, header)
+        string_literal_index = index_string_literals(string_literals)
+
+        # the version follows 127.0.0.1 in the string literal table
+        index = string_literal_index.get("127.0.0.1")
+        if index is not None and index + 1 < len(string_literals) and version_pattern.match(string_literals[index + 1]):
+            results.add(string_literals[index + 1].encode("utf-8"))
+
+        # const strings are stored with the field default values
+        if len(results) == 0:
+            offset, size = header["field_and_parameter_default_value_data"]
+            results.update(pattern.findall(data, offset, offset + size))
+
+    if len(results) == 0:
+        results.update(pattern.findall(data))
+
+    return (results, string_literal_index)
 
 
 def merge_xml_files(manifest_file: Path, input_dir: Path, output_dir: Path):
+    """
+    Merges the xml files listed in the TextAsset manifest (e.g. objects, tiles) into `output_dir/xml`.
+    Every merged element is also added to `output_dir/xml/definitions.db`, indexed by type and id.
+    """
+
     logger.log(logging.INFO, f"Merging xml files...")
     IndentFilter.level += 1
 
@@ -202,6 +695,9 @@ def merge_xml_files(manifest_file: Path, input_dir: Path, output_dir: Path):
         return
 
     manifest = read_json(manifest_file)
+    db_file = output_dir / "xml" / "definitions.db"
+    db = open_xml_database(db_file)
+
     for output_file_name in manifest:
         xml_files = []
         file_names = []
@@ -229,18 +725,20 @@ def merge_xml_files(manifest_file: Path, input_dir: Path, output_dir: Path):
             continue
 
         logger.log(logging.DEBUG, f"Merging {len(xml_files)} files. {file_names}")
-        merged = merge_xml(xml_files)
-
         output_file = output_dir / "xml" / f"{output_file_name}.xml"
-        write_file(output_file, merged, overwrite=False)
+        merge_xml(xml_files, output_file, lambda element, xml: add_xml_element(db, output_file_name, element, xml))
         logger.log(logging.INFO, f"Successfully merged {len(file_names)} files into {output_file_name}.xml")
 
         # TODO: convert to json (see nrelay code)
 
+    close_xml_database(db)
+    logger.log(logging.INFO, f"Indexed definitions in {db_file.name}")
+
     IndentFilter.level -= 1
 
 
 def unpack_launcher_assets(launcher_path, output_path):
+    """ Unpacks the launcher's installer. Returns True if the unpacker succeeded. """
 
     unpacker_file = None
     if os.name == "nt":
@@ -248,26 +746,24 @@ def unpack_launcher_assets(launcher_path, output_path):
     elif os.name == "posix":
         unpacker_file = Constants.LAUNCHER_UNPACKER_LINUX
     else:
-        return
+        return False
 
     logger.log(logging.INFO, "Unpacking launcher assets...")
     IndentFilter.level += 1
 
-    process = subprocess.Popen(
-        [unpacker_file, launcher_path, output_path],
-        stdin=subprocess.PIPE, # bypass "Press any key to exit..."
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
-    )
-
-    logger.pipe(process.stdout)
-    process.wait()
+    result = tools.run("launcher unpacker", [unpacker_file, launcher_path, output_path], timeout=Constants.UNPACKER_TIMEOUT)
 
     logger.log(logging.INFO, "Done!")
     IndentFilter.level -= 1
+    return result.ok
 
 
 def dump_il2cpp(gameassembly: Path, metadata_file: Path, output_dir: Path):
+    """
+    Dumps il2cpp using Il2CppInspector.
+    Dumps are cached by the hashes of GameAssembly.dll, the metadata, the dumper binary and its flags,
+    so an unchanged game assembly is restored from the cache without running the dumper.
+    """
 
     dumper_file = None
     if os.name == "nt":
@@ -282,29 +778,79 @@ def dump_il2cpp(gameassembly: Path, metadata_file: Path, output_dir: Path):
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    process = subprocess.Popen(
+    cache_key = il2cpp_cache_key(dumper_file, gameassembly, metadata_file)
+    cache_dir = Constants.IL2CPP_CACHE_DIR / cache_key if cache_key else None
+
+    if cache_dir is not None and cache_dir.is_dir():
+        logger.log(logging.INFO, f"GameAssembly and metadata are unchanged, restoring dump from cache ({cache_key[:12]})")
+        shutil.copytree(cache_dir, output_dir, copy_function=link_file, dirs_exist_ok=True)
+        os.utime(cache_dir)
+        metrics.count("cache_hits", cache="il2cpp")
+
+        logger.log(logging.INFO, "Done!")
+        IndentFilter.level -= 1
+        return
+
+    metrics.count("cache_misses", cache="il2cpp")
+
+    outputs = []
+    for flag, file_name in IL2CPP_DUMP_OUTPUTS:
+        outputs += [flag, output_dir / file_name]
+
+    result = tools.run(
+        "Il2CppInspector",
         [
             dumper_file, 
             "--bin", gameassembly, 
             "--metadata", metadata_file,
-            "--layout", "class",
-            "--select-outputs",
-            "--py-out",   output_dir / "il2cpp.py",
-            "--json-out", output_dir / "metadata.json",
-            "--cs-out",   output_dir / "types",
-            "--cpp-out",  output_dir / "cpp",
+            *IL2CPP_DUMP_FLAGS,
+            *outputs,
         ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
+        timeout=Constants.IL2CPP_TIMEOUT
     )
 
-    logger.pipe(process.stdout)
-    process.wait()
+    # a failed dump is published as far as it got, but never cached
+    if not result.ok:
+        logger.log(logging.ERROR, "Il2CppInspector failed, the dump may be incomplete")
+    elif cache_dir is not None:
+        store_il2cpp_dump(output_dir, cache_dir)
 
     logger.log(logging.INFO, "Done!")
     IndentFilter.level -= 1
 
 
+def il2cpp_cache_key(dumper_file: Path, gameassembly: Path, metadata_file: Path):
+    """ Returns the dump cache key for the inputs, or None if a file is missing """
+
+    try:
+        hashes = [hash_file(file) for file in [dumper_file, gameassembly, metadata_file]]
+    except OSError as e:
+        logger.log(logging.WARNING, f"Not caching the il2cpp dump. Error: {e}")
+        return None
+
+    flags = IL2CPP_DUMP_FLAGS + [flag for flag, _ in IL2CPP_DUMP_OUTPUTS]
+    key = "\n".join(hashes + flags)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def store_il2cpp_dump(output_dir: Path, cache_dir: Path):
+    """ Adds a dump to the cache, then evicts the least recently used dumps past `Constants.IL2CPP_CACHE_SIZE` """
+
+    temp_dir = cache_dir.with_name(f"{cache_dir.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    shutil.copytree(output_dir, temp_dir, copy_function=link_file)
+
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # cached by another build in the meantime
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    dumps = [dir for dir in Constants.IL2CPP_CACHE_DIR.iterdir() if dir.is_dir() and not dir.name.endswith(".tmp")]
+    dumps.sort(key=lambda dir: dir.stat().st_mtime, reverse=True)
+    for dir in dumps[Constants.IL2CPP_CACHE_SIZE:]:
+        shutil.rmtree(dir, ignore_errors=True)
+
+
 def run_ida_script(gameassembly: Path, work_dir: Path):
     
     if not Constants.IDA_ENABLED:
@@ -329,13 +875,24 @@ def run_ida_script(gameassembly: Path, work_dir: Path):
             "auth": Constants.IDA_AUTH,
         }
 
-        res = requests.post(Constants.IDA_SERVER, params=params)
+        try:
+            res = requests.post(Constants.IDA_SERVER, params=params, timeout=Constants.IDA_TIMEOUT)
+        except requests.Timeout:
+            logger.log(logging.ERROR, f"IDA server did not respond within {Constants.IDA_TIMEOUT:.0f}s")
+            IndentFilter.level -= 1
+            return
+        except requests.RequestException as e:
+            logger.log(logging.ERROR, f"IDA server request failed. Error: {e}")
+            IndentFilter.level -= 1
+            return
+
         logger.log(logging.INFO, f"IDA Server Response: {res.text}")
 
         i64_files = list(Constants.IDA_WORKDIR.glob("*.i64"))
         if len(i64_files) == 0:
             logger.log(logging.INFO, f"Could not find a generated *.i64 file! Aborting.")
-            print(list(Constants.IDA_WORKDIR.glob("*")))
+            logger.log(logging.INFO, f"IDA workdir contents: {list(Constants.IDA_WORKDIR.glob('*'))}")
+            IndentFilter.level -= 1
             return
 
         i64_file = i64_files[0]
@@ -347,4 +904,4 @@ def run_ida_script(gameassembly: Path, work_dir: Path):
 
     # TODO: run IDA binary on local fs (windows)
     # Use Constants.IDA_CMD
-    pass
+    IndentFilter.level -= 1
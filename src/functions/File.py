@@ -1,11 +1,16 @@
 import os
-import subprocess
 import shutil
+import subprocess
 import json
 import logging
+import threading
 from pathlib import Path
 from xml.etree import ElementTree
-from classes import logger, IndentFilter
+from xml.sax.saxutils import escape, quoteattr
+from concurrent.futures import ProcessPoolExecutor
+from classes import Constants
+from classes import logger, IndentFilter, link_file, hash_file
+from functions.Archive import create_archive
 
 def delete_dir_contents(dir_path, hidden_files=False):
     """ use `shutil.rmtree` instead """
@@ -39,6 +44,16 @@ def read_file(file_path):
         return file.read()
 
 
+def format_size(num_bytes):
+    """ Formats a byte count as a human readable string. E.g. 1.5 MB """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+    return f"{num_bytes:.1f} TB"
+
+
 def find_path(dir: Path, search):
     """ Returns the path to a file or directory by search. Uses glob search. """
     result = list(dir.glob(search))
@@ -66,6 +81,80 @@ def rename_duplicate_file(file_path, sep="-"):
     return file_path
 
 
+def merge_dirs(src_dir: Path, dst_dir: Path, overwrite_dirs=()):
+    """
+    Moves the contents of `src_dir` into `dst_dir` in sorted order. Duplicate files are renamed like `write_file` does,
+    except in the relative directories `overwrite_dirs`, where they replace the existing file.
+    Returns a dict of relative path -> new relative path for the renamed files.
+    """
+
+    renamed = {}
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        root = Path(root)
+        out_dir = dst_dir / root.relative_to(src_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        overwrite = root.relative_to(src_dir).as_posix() in overwrite_dirs
+        for file_name in sorted(files):
+            out_file = out_dir / file_name
+            if not overwrite:
+                out_file = rename_duplicate_file(out_file)
+
+            os.replace(root / file_name, out_file)
+
+            if out_file.name != file_name:
+                renamed[(root / file_name).relative_to(src_dir)] = out_file.relative_to(dst_dir)
+
+    shutil.rmtree(src_dir)
+    return renamed
+
+
+def remove_path(path: Path):
+    """ Deletes a file, symlink or directory tree """
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
+
+
+def replace_dir(new_dir: Path, dst_dir: Path):
+    """ Moves `new_dir` to `dst_dir` using renames, then deletes the previous `dst_dir` """
+
+    old_dir = dst_dir.with_name(dst_dir.name + ".old")
+    remove_path(old_dir)
+
+    if dst_dir.is_symlink() or dst_dir.exists():
+        os.rename(dst_dir, old_dir)
+
+    os.rename(new_dir, dst_dir)
+    remove_path(old_dir)
+
+
+def swap_symlink(target: Path, link_path: Path):
+    """
+    Atomically points the symlink `link_path` at `target` (relative to the link's directory).
+    The new link is created under a temporary name and renamed over the old one, so readers always see a complete tree.
+    Returns False if symlinks aren't supported.
+    """
+
+    temp_link = link_path.with_name(link_path.name + ".tmp")
+    remove_path(temp_link)
+
+    try:
+        os.symlink(target, temp_link, target_is_directory=True)
+    except (OSError, NotImplementedError):
+        return False
+
+    if link_path.is_dir() and not link_path.is_symlink():
+        # a directory can't be renamed over, this happens once when upgrading from copied directories
+        replace_dir(temp_link, link_path)
+    else:
+        os.replace(temp_link, link_path)
+
+    return True
+
+
 def write_file(file_path: Path, data, mode="w", overwrite=False, rename_duplicate=True):
 
     Path(file_path).parent.mkdir(parents=True, exist_ok=True)
@@ -79,33 +168,106 @@ def write_file(file_path: Path, data, mode="w", overwrite=False, rename_duplicat
                 logger.log(logging.ERROR, f"Error saving {file_path} ! (overwrite={overwrite}, rename_duplicate={rename_duplicate})")
                 return
 
-    with open(file_path, mode) as file:
+    replace_file(file_path, data, mode)
+    return file_path
+
+
+def replace_file(file_path: Path, data, mode="w"):
+    """
+    Writes `data` to a temporary file, then renames it over `file_path`.
+    An existing output may be hardlinked to a publish store object, so it's never opened for writing.
+    """
+
+    file_path = Path(file_path)
+    temp_file = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp_file, mode) as file:
         file.write(data)
 
+    os.replace(temp_file, file_path)
+
+
+def write_manifest(file_path: Path, entries):
+    """ Writes asset manifest entries as JSON lines, one output file per line """
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    replace_file(file_path, "".join(json.dumps(entry) + "\n" for entry in entries))
+
+
+def read_manifest(file_path: Path):
+    """ Returns a dict of output path -> entry from an asset manifest written by `write_manifest` """
+    entries = {}
+    with open(file_path) as file:
+        for line in file:
+            if line.strip() == "":
+                continue
+
+            entry = json.loads(line)
+            entries[entry["path"]] = entry
+
+    return entries
 
-def merge_xml(files):
-    xml_data = None
-    for file_name in files:
-        data = ElementTree.parse(file_name).getroot()
-        if xml_data is None:
-            xml_data = data
-        else:
-            xml_data.extend(data)
 
-    return ElementTree.tostring(xml_data).decode("utf-8")
+def merge_xml(files, output_file: Path, on_element=None):
+    """
+    Merges the root elements of xml `files` into `output_file`, keeping the first file's root element.
+    Files are parsed incrementally and each child element is written out once it has been parsed,
+    so only one element is held in memory at a time. Returns the path written to.
+    `on_element(element, xml)` is called with every merged element and its serialized bytes.
+    """
 
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    output_file = rename_duplicate_file(output_file)
 
-def archive_build_files(input_path: Path, output_path: Path, archive: bool, file_name="build_files", format="zip"):
+    root_tag = None
+    with open(output_file, "wb") as out:
+        for file_name in files:
+            depth = 0
+            root = None
+
+            for event, element in ElementTree.iterparse(file_name, events=("start", "end")):
+                if event == "start":
+                    if depth == 0:
+                        root = element
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if root_tag is None and depth <= 1:
+                    # the first file's root, written once its leading text has been parsed
+                    root_tag = root.tag
+                    out.write(xml_start_tag(root))
+
+                if depth == 1:
+                    xml = ElementTree.tostring(element)
+                    out.write(xml)
+                    if on_element is not None:
+                        on_element(element, xml)
+
+                    root.remove(element)
+
+        if root_tag is not None:
+            out.write(f"</{root_tag}>".encode("utf-8"))
+
+    return output_file
+
+
+def xml_start_tag(element):
+    attrib = "".join(f" {key}={quoteattr(value)}" for key, value in element.attrib.items())
+    text = escape(element.text or "")
+    return f"<{element.tag}{attrib}>{text}".encode("ascii", "xmlcharrefreplace")
+
+
+def archive_build_files(input_path: Path, output_path: Path, archive: bool, file_name="build_files", format="zip", previous_file: Path = None):
+    """
+    Archives the build files to `output_path/{file_name}.{format}` ("zip" or "tar.zst", see `create_archive`),
+    reusing the unchanged entries of the `previous_file` zip. Without `archive`, the files are linked instead.
+    """
 
     if archive:
         logger.log(logging.INFO, "Archiving build files...")
         IndentFilter.level += 1
 
-        shutil.make_archive(
-            base_name=output_path / file_name,
-            format=format,
-            root_dir=input_path
-        )
+        create_archive(input_path, output_path / f"{file_name}.{format}", previous_file, format)
 
         logger.log(logging.INFO, f"Build files archived ({output_path / file_name}.{format})")
         IndentFilter.level -= 1
@@ -113,22 +275,126 @@ def archive_build_files(input_path: Path, output_path: Path, archive: bool, file
         logger.log(logging.INFO, "Copying build files...")
         IndentFilter.level += 1
 
-        shutil.copytree(input_path, output_path / file_name)
+        # the build files are never modified, so hardlinks are as good as copies
+        shutil.copytree(input_path, output_path / file_name, copy_function=link_file)
 
         logger.log(logging.INFO, f"Build files copied ({output_path / file_name})")
         IndentFilter.level -= 1
     
 
-def diff_directories(left_dir: Path, right_dir: Path):
+def diff_directories(left_dir: Path, right_dir: Path, workers=Constants.EXTRACT_WORKERS):
+    """
+    Compares two directory trees, `left_dir` being the newer one.
+    Files with the same size and content (or the same inode) are skipped, and changed text files
+    are line diffed in a process pool.
+    Returns a tuple of (new_files, deleted_files, new_lines, deleted_lines).
+    """
+
     logger.log(logging.INFO, f"Diff directories: {left_dir} {right_dir}")
 
-    diff_proc = subprocess.Popen(["diff", "--recursive", left_dir, right_dir], stdout=subprocess.PIPE)
-    lines = [ line.decode("utf-8") for line in diff_proc.stdout.readlines()]
+    left_files = list_files(left_dir)
+    right_files = list_files(right_dir)
+
+    new_files = sum(1 for file in left_files if file not in right_files)
+    del_files = sum(1 for file in right_files if file not in left_files)
+
+    changed_files = []
+    for file, left_stat in left_files.items():
+        right_stat = right_files.get(file)
+        if right_stat is None:
+            continue
+
+        # hardlinked from the same publish store object
+        if (left_stat.st_dev, left_stat.st_ino) == (right_stat.st_dev, right_stat.st_ino):
+            continue
+
+        if left_stat.st_size == right_stat.st_size and hash_file(left_dir / file) == hash_file(right_dir / file):
+            continue
+
+        changed_files.append((left_dir / file, right_dir / file))
+
+    new_lines, del_lines = diff_changed_files(changed_files, workers)
+
+    logger.log(logging.INFO, f"{len(changed_files)} changed files")
+    return (new_files, del_files, new_lines, del_lines)
+
+
+def diff_manifests(left_manifest: Path, right_manifest: Path, left_dir: Path, right_dir: Path, workers=Constants.EXTRACT_WORKERS):
+    """
+    Compares the files extracted into `left_dir` and `right_dir` using their asset manifests (see `write_manifest`),
+    `left` being the newer build. The trees aren't walked, only the files whose hash changed are read to be line diffed.
+    Returns a tuple of (new_files, deleted_files, new_lines, deleted_lines) like `diff_directories`.
+    """
+
+    logger.log(logging.INFO, f"Diff manifests: {left_manifest} {right_manifest}")
+
+    left_entries = read_manifest(left_manifest)
+    right_entries = read_manifest(right_manifest)
+
+    new_files = sum(1 for path in left_entries if path not in right_entries)
+    del_files = sum(1 for path in right_entries if path not in left_entries)
+
+    changed_files = [
+        (left_dir / path, right_dir / path)
+        for path, entry in left_entries.items()
+        if path in right_entries and entry["hash"] != right_entries[path]["hash"]
+    ]
+
+    new_lines, del_lines = diff_changed_files(changed_files, workers)
+
+    logger.log(logging.INFO, f"{len(changed_files)} changed files")
+    return (new_files, del_files, new_lines, del_lines)
+
+
+def diff_changed_files(changed_files, workers=Constants.EXTRACT_WORKERS):
+    """ Line diffs each (new file, old file) pair in a process pool. Returns the total (new_lines, deleted_lines). """
+
+    new_lines = 0
+    del_lines = 0
+    if len(changed_files) > 0:
+        with ProcessPoolExecutor(max_workers=max(workers, 1), initializer=logger.initWorker) as executor:
+            for added, removed in executor.map(diff_lines, *zip(*changed_files), chunksize=16):
+                new_lines += added
+                del_lines += removed
+
+    return (new_lines, del_lines)
+
+
+def list_files(dir: Path):
+    """ Returns a dict of relative path -> `os.stat_result` for every file under `dir` """
+
+    files = {}
+    for root, _, file_names in os.walk(dir):
+        for file_name in file_names:
+            file_path = Path(root) / file_name
+            files[file_path.relative_to(dir)] = file_path.stat()
+
+    return files
+
+
+def diff_lines(left_file: Path, right_file: Path):
+    """
+    Returns the number of lines added to and removed from `right_file` to get `left_file`, counted with `diff`.
+    Binary files count as 0 lines.
+    """
+
+    # binary files, like diff's "Binary files ... differ"
+    for file_path in (left_file, right_file):
+        with open(file_path, "rb") as file:
+            if b"\0" in file.read(8192):
+                return (0, 0)
 
-    new_files = sum(1 for line in lines if line.startswith(f"Only in {left_dir}"))
-    del_files = sum(1 for line in lines if line.startswith(f"Only in {right_dir}"))
+    # lines starting with ">" are only in `left_file`, "<" only in `right_file`
+    process = subprocess.run(["diff", right_file, left_file], stdout=subprocess.PIPE)
+    if process.returncode > 1:
+        raise RuntimeError(f"diff {right_file} {left_file} exited with code {process.returncode}")
 
-    new_lines = sum(1 for line in lines if line.startswith(f">"))
-    del_lines = sum(1 for line in lines if line.startswith(f"<"))
+    added = 0
+    removed = 0
+    for line in process.stdout.splitlines():
+        if line.startswith(b">"):
+            added += 1
+        elif line.startswith(b"<"):
+            removed += 1
 
-    return (new_files, del_files, new_lines, del_lines)
\ No newline at end of file
+    return (added, removed)
@@ -0,0 +1,84 @@
+import mmap
+import struct
+from pathlib import Path
+
+# global-metadata.dat starts with this magic number, followed by the metadata version
+METADATA_SANITY = 0xFAB11BAF
+
+# (offset, size) pairs in the header after the sanity and version fields, in order
+METADATA_HEADER_FIELDS = [
+    "string_literal",
+    "string_literal_data",
+    "string",
+    "events",
+    "properties",
+    "methods",
+    "parameter_default_values",
+    "field_default_values",
+    "field_and_parameter_default_value_data",
+]
+
+# StringLiteral { uint32 length; int32 dataIndex; }
+STRING_LITERAL = struct.Struct("<Ii")
+
+
+def open_metadata(metadata_file: Path):
+    """ Memory-maps `global-metadata.dat` read only. The caller closes the returned mmap. """
+    with open(metadata_file, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_metadata_header(data):
+    """
+    Parses the il2cpp metadata header from `data` (bytes or mmap).
+    Returns a dict with the `version` and an (offset, size) tuple for each section in `METADATA_HEADER_FIELDS`,
+    or None if the file isn't il2cpp metadata or a section is out of bounds.
+    """
+
+    header_size = 8 + len(METADATA_HEADER_FIELDS) * 8
+    if len(data) < header_size:
+        return None
+
+    sanity, version = struct.unpack_from("<Ii", data, 0)
+    if sanity != METADATA_SANITY:
+        return None
+
+    header = { "version": version }
+    values = struct.unpack_from(f"<{len(METADATA_HEADER_FIELDS) * 2}i", data, 8)
+    for i, field in enumerate(METADATA_HEADER_FIELDS):
+        offset, size = values[i * 2], values[i * 2 + 1]
+        if offset < 0 or size < 0 or offset + size > len(data):
+            return None
+
+        header[field] = (offset, size)
+
+    return header
+
+
+def read_string_literals(data, header):
+    """ Returns every string literal in the metadata, in table order. Literals which aren't valid utf-8 are decoded with replacement characters. """
+
+    table_offset, table_size = header["string_literal"]
+    data_offset, data_size = header["string_literal_data"]
+    table_size -= table_size % STRING_LITERAL.size
+
+    literals = []
+    for length, data_index in STRING_LITERAL.iter_unpack(data[table_offset:table_offset + table_size]):
+        if data_index < 0 or data_index + length > data_size:
+            literals.append("")
+            continue
+
+        start = data_offset + data_index
+        literals.append(data[start:start + length].decode("utf-8", errors="replace"))
+
+    return literals
+
+
+def index_string_literals(literals):
+    """ Returns a dict of string literal -> index of its first occurrence """
+
+    index = {}
+    for i, literal in enumerate(literals):
+        index.setdefault(literal, i)
+
+    return index
@@ -0,0 +1,94 @@
+import sqlite3
+from pathlib import Path
+
+# child elements stored in their own column, e.g. <Class>Equipment</Class>
+XML_DATABASE_COLUMNS = {
+    "class": "Class",
+    "display_id": "DisplayId",
+    "object_group": "Group",
+}
+
+
+def open_xml_database(db_file: Path):
+    """ Creates an empty sqlite database of xml definitions (objects, tiles) at `db_file`, replacing any existing file """
+
+    db_file = Path(db_file)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    if db_file.exists():
+        db_file.unlink()
+
+    columns = "".join(f", {column} TEXT" for column in XML_DATABASE_COLUMNS)
+
+    db = sqlite3.connect(db_file)
+    db.execute(f"""
+        CREATE TABLE entries (
+            source TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            type INTEGER,
+            type_hex TEXT,
+            id TEXT{columns},
+            xml TEXT NOT NULL
+        )
+    """)
+    return db
+
+
+def add_xml_element(db: sqlite3.Connection, source, element, xml: bytes):
+    """ Inserts a definition element (e.g. <Object type="0x0001" id="...">), `xml` being its serialized form """
+
+    type_hex = element.get("type")
+    values = [
+        source,
+        element.tag,
+        parse_type(type_hex),
+        type_hex,
+        element.get("id"),
+    ]
+    values += [element.findtext(tag) for tag in XML_DATABASE_COLUMNS.values()]
+    values.append(xml.decode("utf-8").strip())
+
+    placeholders = ", ".join("?" for _ in values)
+    db.execute(f"INSERT INTO entries VALUES ({placeholders})", values)
+
+
+def close_xml_database(db: sqlite3.Connection):
+    """ Indexes the definitions by type and id once everything has been inserted, then closes the database """
+
+    db.execute("CREATE INDEX entries_type ON entries (type)")
+    db.execute("CREATE INDEX entries_id ON entries (id)")
+    db.commit()
+    db.execute("VACUUM")
+    db.close()
+
+
+def find_xml_entries(db_file: Path, type=None, id=None):
+    """ Looks up definitions by type (int, or a hex string like "0x0a01") and/or id. Returns a list of rows as dicts. """
+
+    query = "SELECT * FROM entries WHERE 1=1"
+    params = []
+
+    if type is not None:
+        query += " AND type = ?"
+        params.append(parse_type(type) if isinstance(type, str) else type)
+
+    if id is not None:
+        query += " AND id = ?"
+        params.append(id)
+
+    db = sqlite3.connect(db_file)
+    db.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in db.execute(query, params)]
+    finally:
+        db.close()
+
+
+def parse_type(type_hex):
+    """ Parses a type attribute (e.g. "0x0a01") as an int, or None if it's missing or invalid """
+    if type_hex is None:
+        return None
+
+    try:
+        return int(type_hex, 0)
+    except ValueError:
+        return None
@@ -1,3 +1,6 @@
 from .File import *
+from .Metadata import *
+from .XmlDatabase import *
+from .Archive import *
 from .DownloadAssets import *
 from .ExtractAssets import *
\ No newline at end of file
@@ -5,8 +5,13 @@ from datetime import datetime
 from time import sleep
 
 from classes import AppSettings
+from classes import BuildPoller
 from classes import logger
 from classes import Constants
+from classes import PublishStore
+from classes import StageGraph
+from classes import BuildRegistry
+from classes import metrics
 from functions import *
 
 
@@ -15,29 +20,77 @@ def full_build_extract(prod_name, build_name, app_settings):
     work_dir: Path      = Constants.WORK_DIR    / prod_name.lower() / build_name.lower()    # ./output/temp/work/production/client
     publish_dir: Path   = Constants.PUBLISH_DIR / prod_name.lower() / build_name.lower()    # ./output/publish/production/client
 
+    # Clear the previous build's files
+    shutil.rmtree(files_dir, ignore_errors=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
     log_file = work_dir / "log.txt"
     logger.setFileLog(log_file)
     logger.printTime()
 
     logger.log(logging.INFO, f"Starting {prod_name} {build_name}")
-    IndentFilter.level += 1
+    IndentFilter.level = 1
+
+    # metrics are written even if the build fails, to see which stage was slow/failed
+    metrics.start(environment=prod_name, build=build_name)
+    try:
+        with metrics.stage("total"):
+            return process_build(prod_name, build_name, app_settings, files_dir, work_dir, publish_dir)
+    finally:
+        metrics.write(work_dir)
+
+
+def process_build(prod_name, build_name, app_settings, files_dir, work_dir, publish_dir):
+    """
+    Checks, downloads, extracts and publishes a build, once its log and metrics are set up.
+    Returns True if it was published, None if there is no new build to publish, or False if it failed.
+    """
 
     pre_setup = pre_build_setup(prod_name, build_name, app_settings, work_dir, publish_dir)
     if not pre_setup:
-        return False
-
-    build_files_dir = download_archive_build(prod_name, build_name, app_settings, files_dir, work_dir, archive=False)
-    if not build_files_dir:
-        return False
+        return None
+
+    # Only one environment processes a build hash at a time, the others wait to reuse its output
+    registry = BuildRegistry()
+    build_hash = app_settings["build_hash"]
+    with registry.lock(build_name, build_hash):
+        record = registry.get(build_name, build_hash)
+        exalt_version = ""
+
+        # Run the rest of the build as a graph of stages, independent stages run at the same time
+        graph = StageGraph()
+        if record is not None:
+            logger.log(logging.INFO, f"Build already processed by {record['prod_name']}, reusing {record['publish_dir']}")
+            exalt_version = record["exalt_version"]
+            graph.add("reuse", lambda results: reuse_build(Path(record["publish_dir"]), work_dir))
+            output_deps = ["reuse"]
+        else:
+            graph.add("download", lambda results: download_build(prod_name, build_name, app_settings, files_dir))
+            graph.add(
+                "archive",
+                lambda results: archive_build_files(results["download"], work_dir, archive=False, previous_file=publish_dir / "current" / "build_files.zip"),
+                ["download"]
+            )
+            output_deps = ["archive"] + add_extract_stages(graph, build_name, work_dir)
+
+        graph.add(
+            "output",
+            lambda results: output_build(prod_name, build_name, app_settings, work_dir, publish_dir, results.get("exalt_version", (exalt_version, None))[0]),
+            output_deps
+        )
 
-    extracted = extract_build(build_name, build_files_dir, work_dir)
-    if not extracted:
-        return False
+        results = graph.run()
+        if results is None:
+            logger.log(logging.ERROR, f"{prod_name} {build_name} failed")
+            IndentFilter.level -= 1
+            return False
 
-    output_build(prod_name, build_name, app_settings, work_dir, publish_dir, extracted[0])
+        if record is None:
+            registry.add(build_name, build_hash, prod_name, results["output"], results.get("exalt_version", ("", None))[0])
 
     logger.log(logging.INFO, f"Done {prod_name} {build_name}")
     IndentFilter.level -= 1
+    return True
 
 
 def pre_build_setup(prod_name, build_name, app_settings, work_dir, publish_dir):
@@ -67,11 +120,11 @@ def pre_build_setup(prod_name, build_name, app_settings, work_dir, publish_dir):
     return True
 
 
-def download_archive_build(prod_name, build_name, app_settings, files_dir, work_dir, download=True, archive=True):
+def download_build(prod_name, build_name, app_settings, files_dir):
     """
     * Downloads all files for the current build.
     * Launcher assets are automatically unpacked.
-    * Archives all the build files to a .zip in their original state.
+    Returns the directory of the build files, or False if the download failed.
     """
 
     build_url = app_settings["build_cdn"] + app_settings["build_hash"] + "/" + app_settings["build_id"]
@@ -81,57 +134,96 @@ def download_archive_build(prod_name, build_name, app_settings, files_dir, work_
     # if it's the client vs how the launcher exe is unpacked 
     build_files_dir = None
 
-    if download:
-        if build_name == "Client":
-            build_files_dir = download_client_assets(build_url, files_dir)
-        elif build_name == "Launcher":
-            build_files_dir = download_launcher_assets(build_url, app_settings["build_id"], files_dir)
+    if build_name == "Client":
+        build_files_dir = download_client_assets(build_url, files_dir)
+    elif build_name == "Launcher":
+        build_files_dir = download_launcher_assets(build_url, app_settings["build_id"], files_dir)
 
     if build_files_dir is None:
         logger.log(logging.ERROR, f"Failed to download/extract {prod_name} {build_name} assets! Aborting")
         return False
-    
-    archive_build_files(build_files_dir, work_dir, archive)
+
     return build_files_dir
 
 
-def extract_build(build_name, build_files_dir, work_dir):
+def reuse_build(build_dir: Path, work_dir: Path):
+    """
+    Hardlinks the output of a build already published by another environment into `work_dir`.
+    The environment specific files (log, build hash/version, timestamp) are left out, they are written for this environment.
+    """
+
+    environment_files = ["log.txt", "build_hash.txt", "build_version.txt", "timestamp.txt"]
+
+    def ignore(dir, names):
+        if Path(dir) == build_dir:
+            return [name for name in names if name in environment_files]
+        return []
+
+    logger.log(logging.INFO, f"Linking files from {build_dir}")
+    shutil.copytree(build_dir, work_dir, copy_function=link_file, ignore=ignore, dirs_exist_ok=True)
+
+
+def add_extract_stages(graph: StageGraph, build_name, work_dir):
     """
-    * Extracts all Unity assets using UnityPy.
-    * Attempts to extract the current Exalt Version from il2cpp metadata.
+    Adds the extraction stages, which run after the "download" stage:
+    * Extracts all Unity assets using UnityPy, listing every extracted file in asset_manifest.jsonl.
+    * Attempts to extract the current Exalt Version from il2cpp metadata (stage result), for client builds.
     * Merges xml files (objects/tiles), for client builds.
     * Dumps Il2Cpp using  Il2CppInspector.
-    Returns the Exalt Version (for client) or "" for launcher.
+    Returns the names of the stages added.
     """
 
     extracted_assets_dir = work_dir / "extracted_assets"
-    extract_unity_assets(build_files_dir, extracted_assets_dir)
 
-    exalt_version = ""
+    def metadata_file(results):
+        data_dir = find_path(results["download"], "*_Data")
+        return data_dir / "il2cpp_data" / "Metadata" / "global-metadata.dat"
+
+    def gameassembly(results):
+        return results["download"] / "GameAssembly.dll"
+
+    graph.add(
+        "extract_unity",
+        lambda results: extract_unity_assets(results["download"], extracted_assets_dir, work_dir / "asset_manifest.jsonl"),
+        ["download"]
+    )
+    stages = ["extract_unity"]
+
     if build_name == "Client":
         # Extract exalt version (e.g. 1.3.2.1.0)
-        metadata_file = build_files_dir / "RotMG Exalt_Data" / "il2cpp_data" / "Metadata" / "global-metadata.dat"
-        exalt_version = extract_exalt_version(metadata_file, work_dir / "exalt_version.txt")
+        # the result is (version, string literal index), so later stages can look up literals without parsing the metadata again
+        graph.add(
+            "exalt_version",
+            lambda results: extract_exalt_version(metadata_file(results), work_dir / "exalt_version.txt"),
+            ["download"]
+        )
 
-        merge_xml_files(extracted_assets_dir / "TextAsset" / "manifest.json", extracted_assets_dir, work_dir)
+        graph.add(
+            "merge_xml",
+            lambda results: merge_xml_files(extracted_assets_dir / "TextAsset" / "manifest.json", extracted_assets_dir, work_dir),
+            ["extract_unity"]
+        )
+        stages += ["exalt_version", "merge_xml"]
 
     # Dump il2cpp using Il2CppInspector
-    data_dir = find_path(build_files_dir, "*_Data")
-    metadata = data_dir / "il2cpp_data" / "Metadata" / "global-metadata.dat"
-    gameassembly = build_files_dir / "GameAssembly.dll"
-    dump_output = work_dir / "il2cpp_dump"
-    dump_il2cpp(gameassembly, metadata, dump_output)
-    
-    run_ida_script(gameassembly, work_dir)
+    graph.add(
+        "dump_il2cpp",
+        lambda results: dump_il2cpp(gameassembly(results), metadata_file(results), work_dir / "il2cpp_dump"),
+        ["download"]
+    )
+
+    graph.add("ida", lambda results: run_ida_script(gameassembly(results), work_dir), ["download"])
+    stages += ["dump_il2cpp", "ida"]
 
-    return (exalt_version,)
+    return stages
 
 
-def output_build(prod_name, build_name, app_settings: AppSettings, work_dir: Path, publish_dir: Path, exalt_version=""):
+def output_build(prod_name, build_name, app_settings: AppSettings, work_dir: Path, publish_dir: Path, exalt_version="", settle_time=2):
     """
     Performs the final steps for outputting a build after archival/extraction.
     * Writes the current timestamp.txt
     * Copies the output files to the published dir
+    Waits `settle_time` seconds at the end. Returns the published build hash directory.
     """
 
     logger.log(logging.INFO, "Outputting build...")
@@ -140,7 +232,7 @@ def output_build(prod_name, build_name, app_settings: AppSettings, work_dir: Pat
     timestamp = math.floor(datetime.now().timestamp())
     write_file(work_dir / "timestamp.txt", str(timestamp))
 
-    logger.log(logging.INFO, f"Copying output files...")
+    logger.log(logging.INFO, "Publishing output files...")
 
     publish_dir_buildhash: Path = publish_dir / app_settings["build_hash"]
     publish_dir_current: Path = publish_dir / "current"
@@ -151,36 +243,56 @@ def output_build(prod_name, build_name, app_settings: AppSettings, work_dir: Pat
     # calculate diff for webhook
     diff = None
     if Constants.DISCORD_WEBHOOK_URL != "" and publish_dir_current.exists():
-        diff = diff_directories(work_dir / "extracted_assets", publish_dir_current / "extracted_assets")
-
-    # Delete and copy files to /output/{build_hash}
-    if publish_dir_buildhash.exists():
-        logger.log(logging.INFO, f"Deleting {publish_dir_buildhash}")
-        shutil.rmtree(publish_dir_buildhash)
-
-    logger.log(logging.INFO, f"Copying files to {publish_dir_buildhash}")
-    shutil.copytree(work_dir, publish_dir_buildhash)
-
-    # Delete and copy files to /output/current
-    if publish_dir_current.exists():
-        logger.log(logging.INFO, f"Deleting {publish_dir_current}")
-        shutil.rmtree(publish_dir_current)
-
-    logger.log(logging.INFO, f"Copying files to {publish_dir_current}")
-    shutil.copytree(work_dir, publish_dir_current)
-
-    # Create current.zip
+        manifest_file = work_dir / "asset_manifest.jsonl"
+        previous_manifest_file = publish_dir_current / "asset_manifest.jsonl"
+
+        if manifest_file.is_file() and previous_manifest_file.is_file():
+            diff = diff_manifests(manifest_file, previous_manifest_file, work_dir / "extracted_assets", publish_dir_current / "extracted_assets")
+        else:
+            # builds published before asset manifests were written
+            diff = diff_directories(work_dir / "extracted_assets", publish_dir_current / "extracted_assets")
+
+    # Add the output files to the publish store, then hardlink them into /output/{build_hash}
+    # log.txt is still being written to, so it is copied instead
+    logger.log(logging.INFO, "Adding files to the publish store")
+    publish_store = PublishStore()
+    objects = publish_store.add_tree(work_dir, copied_files=("log.txt",))
+
+    # Link into a temporary directory first, so a republished build hash is replaced in one step
+    logger.log(logging.INFO, f"Linking files to {publish_dir_buildhash}")
+    publish_dir_temp = publish_dir_buildhash.with_name(publish_dir_buildhash.name + ".tmp")
+    remove_path(publish_dir_temp)
+    publish_store.link_tree(objects, publish_dir_temp)
+    replace_dir(publish_dir_temp, publish_dir_buildhash)
+
+    # Point /output/current at the new build
+    logger.log(logging.INFO, f"Switching {publish_dir_current} to {publish_dir_buildhash.name}")
+    if not swap_symlink(Path(publish_dir_buildhash.name), publish_dir_current):
+        logger.log(logging.WARNING, f"Symlinks are not supported, linking files to {publish_dir_current} instead")
+        publish_dir_temp = publish_dir_current.with_name(publish_dir_current.name + ".tmp")
+        remove_path(publish_dir_temp)
+        publish_store.link_tree(objects, publish_dir_temp)
+        replace_dir(publish_dir_temp, publish_dir_current)
+
+    publish_store.gc()
+
+    # Create current.zip under a temporary name, then rename it into place
+    # the files unchanged since the previous current.zip are copied from it without recompressing
     if Constants.CREATE_CURRENT_ZIP:
         logger.log(logging.INFO, f"Creating current.zip")
         current_zip = publish_dir / "current.zip"
-        if current_zip.exists():
-            current_zip.unlink()
+        temp_zip = publish_dir / "current.tmp.zip"
 
-        shutil.make_archive(
-            base_name=publish_dir / "current",
-            format="zip",
-            root_dir=publish_dir_current
-        )
+        create_archive(publish_dir_current, temp_zip, previous_file=current_zip)
+        os.replace(temp_zip, current_zip)
+
+    if Constants.CREATE_CURRENT_TAR_ZST:
+        logger.log(logging.INFO, "Creating current.tar.zst")
+        current_tar = publish_dir / "current.tar.zst"
+        temp_tar = publish_dir / "current.tmp.tar.zst"
+
+        if create_archive(publish_dir_current, temp_tar, format="tar.zst") is not None:
+            os.replace(temp_tar, current_tar)
 
     # send webhook, after all files have been copied
     if diff and build_name == "Client":
@@ -210,11 +322,11 @@ def output_build(prod_name, build_name, app_settings: AppSettings, work_dir: Pat
 
         requests.post(Constants.DISCORD_WEBHOOK_URL, json=webhook_json)
 
-    sleep(2)
+    sleep(settle_time)
 
     logger.log(logging.INFO, f"Done!")
     IndentFilter.level -= 1
-    return True
+    return publish_dir_buildhash
 
 
 def main():
@@ -225,22 +337,10 @@ def main():
 
     # Setup logger
     logger.setup()
-    
-    prod_names = Constants.ROTMG_URLS.keys()
-    for prod_name in prod_names:
-        app_settings = AppSettings(Constants.ROTMG_URLS[prod_name])
-        full_build_extract(prod_name, "Client", app_settings.client)
-
-        if Constants.EXTRACT_LAUNCHER:
-            full_build_extract(prod_name, "Launcher", app_settings.launcher)
 
-    logger.log(logging.INFO, "Done!")
-
-    # loop the main function to continuously check for new builds 
-    loop_time = 10 # minutes
-    logger.log(logging.INFO, f"Looping in {loop_time} minutes...\n\n")
-    sleep(loop_time * 60)
-    main()
+    # continuously check every environment for new builds
+    poller = BuildPoller(Constants.ROTMG_URLS, full_build_extract)
+    poller.run()
 
 
 if __name__ == "__main__":